@@ -1,10 +1,13 @@
+import copy
+import time
+
 import matplotlib.pyplot as plt
 import numpy
 import seaborn
 import torch
 
 import models
-from self_play import MCTS, Node, SelfPlay
+from self_play import MCTS, GameHistory, Node, SelfPlay
 
 
 class DiagnoseModel:
@@ -20,10 +23,9 @@ class DiagnoseModel:
     def __init__(self, checkpoint, config):
         self.config = config
 
-        # Initialize the network
-        self.model = models.MuZeroNetwork(self.config)
+        # Initialize the network, with the inference backend of the actors
+        self.model = models.inference_network(self.config, torch.device("cpu"))
         self.model.set_weights(checkpoint["weights"])
-        self.model.eval()
 
     def get_virtual_trajectory_from_obs(
         self, observation, horizon, plot=True, to_play=0
@@ -36,7 +38,7 @@ class DiagnoseModel:
         root, mcts_info = MCTS(self.config).run(
             self.model, observation, self.config.action_space, to_play, True
         )
-        trajectory_info.store_info(root, mcts_info, None, numpy.NaN)
+        trajectory_info.store_info(root, mcts_info, None, numpy.nan)
 
         virtual_to_play = to_play
         for i in range(horizon):
@@ -53,8 +55,9 @@ class DiagnoseModel:
                 root.hidden_state,
                 torch.tensor([[action]]).to(root.hidden_state.device),
             )
-            value = models.support_to_scalar(value, self.config.support_size).item()
-            reward = models.support_to_scalar(reward, self.config.support_size).item()
+            value, reward = models.support_to_scalars(
+                (value, reward), self.config.support_size
+            )[:, 0].tolist()
             root = Node(0)
             root.expand(
                 self.config.action_space,
@@ -102,7 +105,7 @@ class DiagnoseModel:
             True,
         )
         self.plot_mcts(root, plot)
-        real_trajectory_info.store_info(root, mcts_info, None, numpy.NaN)
+        real_trajectory_info.store_info(root, mcts_info, None, numpy.nan)
         for i, action in enumerate(virtual_trajectory_info.action_history):
             # Follow virtual trajectory until it reaches an illegal move in the real env
             if action not in game.legal_actions():
@@ -136,6 +139,91 @@ class DiagnoseModel:
             trajectory_divergence_index,
         )
 
+    def compare_inference_backend(self, game, num_positions, backend="quantized"):
+        """
+        Compare an inference backend of the CPU actors with the float32 network on
+        positions of games played with random legal moves: agreement of the policies and
+        of the actions chosen by MCTS, and simulations per second of each.
+
+        Returns:
+            A dict with the policy and action agreement with the float32 network and the
+            simulations per second of both networks.
+        """
+        positions = []
+        while len(positions) < num_positions:
+            game_history = GameHistory()
+            observation = game.reset()
+            game_history.action_history.append(0)
+            game_history.observation_history.append(observation)
+            done = False
+            while not done and len(positions) < num_positions:
+                positions.append(
+                    (
+                        game_history.get_stacked_observations(
+                            -1, self.config.stacked_observations
+                        ),
+                        # The mask of the game is only valid until its next move
+                        copy.copy(SelfPlay.root_legal_actions(game)),
+                        game.to_play(),
+                    )
+                )
+                action = numpy.random.choice(game.legal_actions())
+                observation, _, done = game.step(action)
+                game_history.action_history.append(action)
+                game_history.observation_history.append(observation)
+
+        results = []
+        for name in ("torch", backend):
+            config = copy.copy(self.config)
+            config.inference_backend = name
+            model = models.inference_network(config, torch.device("cpu"))
+            model.set_weights(self.model.get_weights())
+            # Warm up, the quantized network is calibrated on its first observation
+            MCTS(config).run(model, *positions[0], False)
+            # Same random tie breaks in the searches of both networks
+            numpy.random.seed(self.config.seed)
+
+            start = time.time()
+            actions = [
+                SelfPlay.select_action(
+                    MCTS(config).run(model, *position, False)[0], 0
+                )
+                for position in positions
+            ]
+            simulations_per_second = (
+                num_positions * self.config.num_simulations / (time.time() - start)
+            )
+            _, _, policy_logits, _ = model.initial_inference(
+                torch.tensor(
+                    numpy.array([observation for observation, _, _ in positions]),
+                    dtype=torch.float32,
+                )
+            )
+            results.append(
+                (
+                    numpy.array(actions),
+                    policy_logits.argmax(-1).numpy(),
+                    simulations_per_second,
+                )
+            )
+
+        (actions, policies, speed), (
+            backend_actions,
+            backend_policies,
+            backend_speed,
+        ) = results
+        comparison = {
+            "policy_agreement": float(numpy.mean(policies == backend_policies)),
+            "action_agreement": float(numpy.mean(actions == backend_actions)),
+            "float32_simulations_per_second": speed,
+            f"{backend}_simulations_per_second": backend_speed,
+        }
+        print(
+            f"{backend} agrees with float32 on {comparison['policy_agreement']:.1%} of the policies and {comparison['action_agreement']:.1%} of the MCTS actions. "
+            f"Simulations per second: {speed:.0f} in float32, {backend_speed:.0f} in {backend}."
+        )
+        return comparison
+
     def close_all(self):
         plt.close("all")
 
@@ -203,10 +291,10 @@ class Trajectoryinfo:
         self.policies_after_planning = []
         # Not implemented, need to store them in every nodes of the mcts
         self.prior_values = []
-        self.values_after_planning = [[numpy.NaN] * len(self.config.action_space)]
+        self.values_after_planning = [[numpy.nan] * len(self.config.action_space)]
         self.prior_root_value = []
         self.root_value_after_planning = []
-        self.prior_rewards = [[numpy.NaN] * len(self.config.action_space)]
+        self.prior_rewards = [[numpy.nan] * len(self.config.action_space)]
         self.mcts_depth = []
 
     def store_info(self, root, mcts_info, action, reward, new_prior_root_value=None):
@@ -218,7 +306,7 @@ class Trajectoryinfo:
             [
                 root.children[action].prior
                 if action in root.children.keys()
-                else numpy.NaN
+                else numpy.nan
                 for action in self.config.action_space
             ]
         )
@@ -226,7 +314,7 @@ class Trajectoryinfo:
             [
                 root.children[action].visit_count / self.config.num_simulations
                 if action in root.children.keys()
-                else numpy.NaN
+                else numpy.nan
                 for action in self.config.action_space
             ]
         )
@@ -234,7 +322,7 @@ class Trajectoryinfo:
             [
                 root.children[action].value()
                 if action in root.children.keys()
-                else numpy.NaN
+                else numpy.nan
                 for action in self.config.action_space
             ]
         )
@@ -248,7 +336,7 @@ class Trajectoryinfo:
             [
                 root.children[action].reward
                 if action in root.children.keys()
-                else numpy.NaN
+                else numpy.nan
                 for action in self.config.action_space
             ]
         )
@@ -4,7 +4,6 @@ import random
 import gym
 import numpy
 import torch
-import pandas as pd
 import numpy as np
 from .abstract_game import AbstractGame
 
@@ -29,9 +28,15 @@ class MuZeroConfig:
 
         ### Self-Play
         self.num_workers = 1  # Number of simultaneous threads/workers self-playing to feed the replay buffer
+        self.games_per_worker = 1  # Number of games played in lockstep by each self-play worker, their searches are batched together in the network calls (VectorSelfPlay). 1 plays one game at a time (SelfPlay)
+        self.use_inference_server = False  # Evaluate the network of the self-play and reanalyse workers in a single InferenceServer actor which batches their requests
+        self.inference_batch_size = 64  # Maximum number of positions evaluated together by the InferenceServer
+        self.inference_max_latency = 0.002  # Maximum number of seconds a request waits for its batch to be filled
         self.selfplay_on_gpu = True
+        self.inference_backend = "torch"  # "torch" (float32), "quantized" (int8, dynamic for the Linear layers and static for the convolutions, slower than "torch" for small models and less accurate, only worth trying for wide resnet models) or "onnx" (ONNX Runtime, needs onnx and onnxruntime) network of the self-play and reanalyse actors running on the CPU
         self.max_moves = 30  # Maximum number of moves if game is not finished before
         self.num_simulations = 10  # Number of future moves self-simulated
+        self.mcts_batch_size = 1  # Number of leaves selected with a virtual loss and evaluated in a single recurrent_inference call at each round of the MCTS. 1 keeps the sequential search
         self.discount = 0.997  # Chronological discount of the reward
         self.temperature_threshold = None  # Number of moves before dropping the temperature given by visit_softmax_temperature_fn to 0 (ie selecting the best action). If None, visit_softmax_temperature_fn is used every time
 
@@ -71,9 +76,13 @@ class MuZeroConfig:
         self.save_model = True  # Save the checkpoint in results_path as model.checkpoint
         self.training_steps = 30 * 1000  # Total number of training steps (ie weights update according to a batch)
         self.batch_size = 128  # Number of parts of games to train on at each training step
+        self.prefetch_batches = 2  # Number of batches requested in advance by the trainer so that one is always ready
+        self.num_batch_builders = 0  # Number of actors assembling batches in parallel from the games the replay buffer publishes in the object store. 0 lets the replay buffer assemble them
         self.checkpoint_interval = 10  # Number of training steps before using the model for self-playing
         self.value_loss_weight = 0.25  # Scale the value loss to avoid overfitting of the value function, paper recommends 0.25 (See paper appendix Reanalyze) noi usiamo 1
         self.train_on_gpu = torch.cuda.is_available()  # Train on GPU if available
+        self.training_precision = "float32"  # "float32" or "bfloat16" to train under bfloat16 autocast, on CPU as well as on GPU
+        self.compile_training_step = False  # Compile the unrolled training step and loss with torch.compile (needs a working torch.compile backend)
 
         self.optimizer = "Adam"  # "Adam" or "SGD". Paper uses SGD
         self.weight_decay = 1e-4  # L2 weights regularization
@@ -854,53 +863,6 @@ class Azul:
         #ToDO board azul
         self.board = self.board_to_obs()
 
-    def board_to_obs_1D(self):
-
-        # processo per p1 ----------------------------------------------
-        lst_penality_p1_and_score = self.game.penalty_row_p1 + [0, self.game.p1_score]
-
-        np_penality_p1_and_score = np.array(lst_penality_p1_and_score)
-        np_penality_p1_and_score.resize(5, 2)
-        pd_penality_p1_and_score = pd.DataFrame(np_penality_p1_and_score)
-
-        pd_row_p1 = pd.DataFrame(self.game.rows_p1).fillna(0)
-        row_p1_with_penality_and_score = pd.concat([pd_row_p1, pd_penality_p1_and_score], axis=1).to_numpy().astype(int)
-
-        #stesso processo per p2 -----------------------------------------
-        lst_penality_p2_and_score = self.game.penalty_row_p2 + [0, self.game.p2_score]
-
-        np_penality_p2_and_score = np.array(lst_penality_p2_and_score)
-        np_penality_p2_and_score.resize(5, 2)
-        pd_penality_p2_and_score = pd.DataFrame(np_penality_p2_and_score)
-
-        pd_row_p2 = pd.DataFrame(self.game.rows_p2).fillna(0)
-        row_p2_with_penality_and_score = pd.concat([pd_row_p2, pd_penality_p2_and_score], axis=1).to_numpy().astype(int)
-
-        ###------------------------------------------------------------####
-        #common pit
-
-        pd_drawing_pit = pd.DataFrame(self.game.drawing_pit)
-        pd_drawing_pit_trapsposte = pd_drawing_pit.transpose()
-        #pd_drawing_pit_trapsposte.loc[len(pd_drawing_pit_trapsposte)] = 0
-        zero_col =[7,8,9,10,11,12]
-        for colum in zero_col:
-            pd_drawing_pit_trapsposte[colum] = 0
-        complete_board_common_pit = pd_drawing_pit_trapsposte.to_numpy()
-        
-
-        #-------------------------#
-        
-        #complete_board = []
-        complete_board_p1 = np.concatenate([self.game.board_p1,row_p1_with_penality_and_score], axis=1)
-        complete_board_p2 = np.concatenate([self.game.board_p2,row_p2_with_penality_and_score], axis=1)
-
-        complete_board_players =  np.concatenate([complete_board_p1,complete_board_p2], axis=0)
-        #print(complete_board_common_pit)  
-        #print(complete_board_players)   
-        complete_board =  np.concatenate([complete_board_players,complete_board_common_pit], axis=0)
-        #print(complete_board.shape)
-        return [complete_board_p1,complete_board_p2]
-    
     def board_to_obs(self):
 
         obs_rows_p1 = []
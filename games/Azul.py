@@ -1,3 +1,4 @@
+import copy
 import datetime
 import os
 
@@ -7,7 +8,6 @@ import torch
 from .abstract_game import AbstractGame
 import numpy as np
 import random
-import pandas as pd
 
 class MuZeroConfig:
     def __init__(self):
@@ -32,9 +32,15 @@ class MuZeroConfig:
 
         ### Self-Play
         self.num_workers = 1  # Number of simultaneous threads/workers self-playing to feed the replay buffer
+        self.games_per_worker = 8  # Number of games played in lockstep by each self-play worker, their searches are batched together in the network calls (VectorSelfPlay). 1 plays one game at a time (SelfPlay)
+        self.use_inference_server = False  # Evaluate the network of the self-play and reanalyse workers in a single InferenceServer actor which batches their requests
+        self.inference_batch_size = 64  # Maximum number of positions evaluated together by the InferenceServer
+        self.inference_max_latency = 0.002  # Maximum number of seconds a request waits for its batch to be filled
         self.selfplay_on_gpu = False
+        self.inference_backend = "torch"  # "torch" (float32), "quantized" (int8, dynamic for the Linear layers and static for the convolutions, slower than "torch" for small models and less accurate, only worth trying for wide resnet models) or "onnx" (ONNX Runtime, needs onnx and onnxruntime) network of the self-play and reanalyse actors running on the CPU
         self.max_moves = 2000  # Maximum number of moves if game is not finished before
         self.num_simulations = 25  # Number of future moves self-simulated
+        self.mcts_batch_size = 1  # Number of leaves selected with a virtual loss and evaluated in a single recurrent_inference call at each round of the MCTS. 1 keeps the sequential search
         self.discount = 1  # Chronological discount of the reward
         self.temperature_threshold = None  # Number of moves before dropping the temperature given by visit_softmax_temperature_fn to 0 (ie selecting the best action). If None, visit_softmax_temperature_fn is used every time
 
@@ -77,9 +83,13 @@ class MuZeroConfig:
         self.results_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../results", os.path.basename(__file__)[:-3], datetime.datetime.now().strftime("%Y-%m-%d--%H-%M-%S"))  # Path to store the model weights and TensorBoard logs
         
         self.batch_size = 64  # Number of parts of games to train on at each training step
+        self.prefetch_batches = 2  # Number of batches requested in advance by the trainer so that one is always ready
+        self.num_batch_builders = 0  # Number of actors assembling batches in parallel from the games the replay buffer publishes in the object store. 0 lets the replay buffer assemble them
         self.checkpoint_interval = 10  # Number of training steps before using the model for self-playing
         self.value_loss_weight = 0.25  # Scale the value loss to avoid overfitting of the value function, paper recommends 0.25 (See paper appendix Reanalyze)
         self.train_on_gpu = torch.cuda.is_available()  # Train on GPU if available
+        self.training_precision = "float32"  # "float32" or "bfloat16" to train under bfloat16 autocast, on CPU as well as on GPU
+        self.compile_training_step = False  # Compile the unrolled training step and loss with torch.compile (needs a working torch.compile backend)
 
         self.optimizer = "Adam"  # "Adam" or "SGD". Paper uses SGD
         self.weight_decay = 1e-4  # L2 weights regularization
@@ -130,7 +140,7 @@ class Game(AbstractGame):
     """
 
     def __init__(self, seed=None):
-        self.env = Azul()
+        self.env = Azul(seed)
 
     def step(self, action):
         """
@@ -167,6 +177,17 @@ class Game(AbstractGame):
         """
         return self.env.legal_actions()
 
+    def legal_actions_mask(self):
+        """
+        Boolean mask of the legal actions over the action space, used to mask the root of
+        the search without building the list of legal actions.
+
+        Returns:
+            A read-only boolean array of the length of the action space, only valid
+            until the next step or reset.
+        """
+        return self.env.legal_actions_mask()
+
     def reset(self):
         """
         Reset the game for a new game.
@@ -219,599 +240,390 @@ class Game(AbstractGame):
         return f"Play column {action_number + 1}"
 
 
-class Azul_game():
-
-    def __init__(self):
-
-        self.p1_score = 0
-        self.p2_score = 0
-
-        self.player_turn = "P1"
-        self.initial_player = "P1"
-        #refattorizza nome
-        self.new_first_player = True
-
-        self.board_p1 = np.zeros((5, 5), dtype=int)
-        self.board_p2 = np.zeros((5, 5), dtype=int)
-
-        self.rows_p1 = self.initialize_rows()
-        self.rows_p2 = self.initialize_rows()
-
-        self.penalty_row_p1 = [0, 0, 0, 0, 0, 0, 0]
-        self.penalty_row_p2 = [0, 0, 0, 0, 0, 0, 0]
-
-        self.create_drawing_pit()
-
-        self.gameover = False
-        self.is_done_phase = False
-
-        self.penality_for_action = 0
-
-
-    def initialize_rows(self):
-
-        first_row = np.zeros(1, dtype=int)
-        second_row = np.zeros(2, dtype=int)
-        third_row = np.zeros(3, dtype=int)
-        fourth_row = np.zeros(4, dtype=int)
-        fifth_row = np.zeros(5, dtype=int)
-
-        # return [first_row , second_row , third_row , fourth_row , fifth_row]
-        return [[0], [0, 0], [0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0, 0]]
-
-    def create_drawing_pit(self):
-        pit_collection = []
-
-        #
-        self.new_first_player = True
-        self.player_turn = self.initial_player
-        self.is_done_phase = False
-
-        for i in range(5):
-            pit = [0, 0, 0, 0, 0]
-
-            for j in range(4):
-                generated_tile_type = np.random.randint(0, 5)
-                pit[generated_tile_type] = pit[generated_tile_type] + 1
-
-            pit_collection.append(pit)
-
-        discard_pit = [0, 0, 0, 0, 0]
-        pit_collection.append(discard_pit)
-
-        self.penalty_row_p1 = [0, 0, 0, 0, 0, 0, 0]
-        self.penalty_row_p2 = [0, 0, 0, 0, 0, 0, 0]
-        self.drawing_pit =  pit_collection
-
-    def play_turn(self, player, pit_choice, tile_type, column_choice):
-        
-        self.penality_for_action = 0
-
-        #controlla se è una mossa valida
-        if(self.valid_move(player, pit_choice, tile_type, column_choice)):
-            drawed_tiles = self.take_tile_from_pit(pit_choice, tile_type,player)
-
-            if(pit_choice == 5 and self.new_first_player):
-                self.initial_player = player
-                self.new_first_player = False
-                #aggiunge 1 penalità
-                self.insert_tiles_in_penalty_column(1, player)
+class AzulEngine:
+    """
+    Azul rules for two players on a fixed-size integer state.
 
-            # inserisci tile nella colonna specificata del player
+    The whole state is a single int16 array (the scores do not fit in int8) and the
+    factories, walls, pattern lines, penalty rows and scores are views into it indexed
+    by player number, so there are no per-player attributes or string compares.
 
-            if (column_choice != 5):
-                    self.insert_tiles_in_column(tile_type, drawed_tiles, column_choice, player)
-            else:
-                # se 5 allora inserisci direttamente nella colonna penalità
-                self.insert_tiles_in_penalty_column(drawed_tiles, player)
+    Actions are encoded as pit + tile * 6 + row * 30: pits 0-4 are the factories and pit 5
+    the center, row 5 sends the tiles straight to the penalty row.
+    """
 
-            if self.player_turn == "P1":
-                self.player_turn = "P2"
-            else:
-                self.player_turn = "P1"
+    num_pits = 6
+    num_tiles = 5
+    num_rows = 6
+
+    # Fields of the state array and their shapes
+    fields = (
+        ("factories", (6, 5)),  # Tiles of each color in the factories and the center (pit 5)
+        ("walls", (2, 5, 5)),  # 1 where a tile is placed on the wall
+        ("line_colors", (2, 5)),  # tile + 1 of the tiles in each pattern line, 0 when empty
+        ("line_counts", (2, 5)),  # Number of tiles in each pattern line
+        ("penalties", (2,)),  # Number of filled slots of the penalty row
+        ("scores", (2,)),
+        ("info", (4,)),  # Player to play, first player of the next round, first player token still in the center, game over
+    )
+    PLAYER, FIRST_PLAYER, FIRST_PLAYER_TOKEN, GAMEOVER = range(4)
+
+    # Points lost with the n first slots of the penalty row filled
+    penalty_points = np.array([0, 1, 2, 4, 6, 8, 11, 14])
+    # Column of the wall where each color goes in each row: wall_columns[tile, row]
+    wall_columns = (np.arange(5)[:, None] + np.arange(5)[None, :]) % 5
+    tile_colors = np.arange(1, 6)
 
-            return True
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        # Slice of the state array of each field
+        self.field_slices = []
+        offset = 0
+        for name, shape in self.fields:
+            size = int(np.prod(shape))
+            self.field_slices.append((name, slice(offset, offset + size), shape))
+            offset += size
+        self.state = np.zeros(offset, dtype=np.int16)
+        self.bind_fields()
+        # Penalty points of the last action, for the reward
+        self.penalty_for_action = 0
+        # Whether the last action ended the round
+        self.round_ended = False
+        # Colors each row of each player can take: row_accepts[player, row, tile], the
+        # legal actions are the colors of each pit accepted by the rows of the player to
+        # play. Both are updated after each move instead of checking the 180 actions.
+        self.row_accepts = np.ones((2, self.num_rows, self.num_tiles), dtype=bool)
+        self.legal_mask = np.zeros(
+            self.num_pits * self.num_tiles * self.num_rows, dtype=bool
+        )
+        self.reset()
+
+    def bind_fields(self):
+        # Set the fields as views into the state array
+        for name, field_slice, shape in self.field_slices:
+            setattr(self, name, self.state[field_slice].reshape(shape))
+
+    def snapshot(self):
+        """
+        Copy the state, with the state of the generator of the factories so that the
+        rounds drawn after a restore are the same.
+        """
+        return (
+            self.state.copy(),
+            self.row_accepts.copy(),
+            self.legal_mask.copy(),
+            self.penalty_for_action,
+            self.round_ended,
+            self.rng.bit_generator.state,
+        )
+
+    def restore(self, snapshot):
+        (
+            state,
+            row_accepts,
+            legal_mask,
+            self.penalty_for_action,
+            self.round_ended,
+            self.rng.bit_generator.state,
+        ) = snapshot
+        # Copied in place, the fields and the legal mask returned before stay valid
+        self.state[:] = state
+        self.row_accepts[:] = row_accepts
+        self.legal_mask[:] = legal_mask
+
+    def clone(self):
+        engine = copy.copy(self)
+        # Faster than a deepcopy of the generator
+        engine.rng = np.random.Generator(np.random.PCG64(0))
+        engine.rng.bit_generator.state = self.rng.bit_generator.state
+        engine.state = self.state.copy()
+        engine.bind_fields()
+        engine.row_accepts = self.row_accepts.copy()
+        engine.legal_mask = self.legal_mask.copy()
+        return engine
 
-        return False
+    def reset(self):
+        self.state[:] = 0
+        self.penalty_for_action = 0
+        self.fill_factories()
+        for player in range(2):
+            for row in range(5):
+                self.update_row_accepts(player, row)
+        self.update_legal_mask()
+
+    def fill_factories(self):
+        """
+        Start a new round: draw 4 random tiles in each factory and give the turn to the
+        player who took the first player token.
+        """
+        draws = self.rng.integers(0, self.num_tiles, size=(5, 4))
+        self.factories[:5] = (draws[:, :, None] == np.arange(self.num_tiles)).sum(axis=1)
+        self.factories[5] = 0
+        self.penalties[:] = 0
+        self.info[self.PLAYER] = self.info[self.FIRST_PLAYER]
+        self.info[self.FIRST_PLAYER_TOKEN] = 1
 
-    def valid_move(self, player, pit_choice, tile_type, column_choice):
+    def to_play(self):
+        return int(self.info[self.PLAYER])
+
+    def is_gameover(self):
+        return bool(self.info[self.GAMEOVER])
+
+    @staticmethod
+    def decode_action(action):
+        return action % 6, (action // 6) % 5, action // 30
+
+    @staticmethod
+    def encode_action(pit, tile, row):
+        return pit + tile * 6 + row * 30
+
+    def update_row_accepts(self, player, row):
+        # A row takes the colors whose cell of the wall is empty, and only the color
+        # already in the row if it is not empty. The penalty row (5) takes every color.
+        color = self.line_colors[player, row]
+        self.row_accepts[player, row] = (
+            self.walls[player, row, self.wall_columns[:, row]] == 0
+        ) & ((color == 0) | (self.tile_colors == color))
+
+    def update_legal_mask(self):
+        # The actions pit + tile * 6 + row * 30 are laid out as [row, tile, pit]
+        np.logical_and(
+            self.row_accepts[self.to_play()][:, :, None],
+            self.factories.T[None, :, :] > 0,
+            out=self.legal_mask.reshape(self.num_rows, self.num_tiles, self.num_pits),
+        )
+
+    def legal_actions_mask(self):
+        """
+        Boolean mask of the legal actions over the action space, as a read-only view which
+        is updated in place by the following moves: copy it to keep it across a step.
+        """
+        legal_mask = self.legal_mask.view()
+        legal_mask.flags.writeable = False
+        return legal_mask
 
-        drawed_tile = self.drawing_pit[pit_choice][tile_type]
+    def legal_actions(self):
+        return np.flatnonzero(self.legal_mask).tolist()
 
-        if(drawed_tile == 0):
-            return False
+    def play(self, action):
+        """
+        Take the tiles of one color from a pit and place them in a pattern line of the
+        player to play, the tiles which do not fit go to the penalty row.
 
-        if (player == "P1"):
-            rows = self.rows_p1
-            scoreboard = self.board_p1
-        else:
-            rows = self.rows_p2
-            scoreboard = self.board_p2
-        if(column_choice != 5):
-            position = ((tile_type + column_choice) % 5)
-            if (scoreboard[column_choice][position] == 1):
-                return False
-            if (rows[column_choice][0] == 0 or rows[column_choice][0] == tile_type + 1):
-                return True
+        Returns:
+            False if the move is not valid, the state is then unchanged.
+        """
+        self.penalty_for_action = 0
+        if not self.legal_mask[action]:
             return False
+        player = self.to_play()
+        pit, tile, row = self.decode_action(action)
+
+        drawn_tiles = int(self.factories[pit, tile])
+        self.factories[pit, tile] = 0
+        if pit != 5:
+            self.factories[5] += self.factories[pit]
+            self.factories[pit] = 0
+        elif self.info[self.FIRST_PLAYER_TOKEN]:
+            self.info[self.FIRST_PLAYER_TOKEN] = 0
+            self.info[self.FIRST_PLAYER] = player
+            self.add_penalty(player, 1)
+
+        if row != 5:
+            placed_tiles = min(drawn_tiles, row + 1 - int(self.line_counts[player, row]))
+            if placed_tiles:
+                self.line_colors[player, row] = tile + 1
+                self.line_counts[player, row] += placed_tiles
+                self.update_row_accepts(player, row)
+            drawn_tiles -= placed_tiles
+        self.add_penalty(player, drawn_tiles)
+
+        self.info[self.PLAYER] = 1 - player
+        return True
+
+    def add_penalty(self, player, number_of_tiles):
+        # The tiles beyond the 7 slots of the penalty row are discarded
+        filled = int(self.penalties[player])
+        new_filled = min(filled + number_of_tiles, 7)
+        self.penalties[player] = new_filled
+        self.penalty_for_action += int(
+            self.penalty_points[new_filled] - self.penalty_points[filled]
+        )
 
-        else: return True
-
-    def take_tile_from_pit(self, pit_choice, tile_type, player):
-
-        drawed_tiles = self.drawing_pit[pit_choice][tile_type]
-        self.drawing_pit[pit_choice][tile_type] = 0
-
-        if not self.new_first_player:
-            self.new_first_player = False
-            self.initial_player = player
-
-        if (pit_choice != 5):
-            for i in range(5):
-                discarded_tile = self.drawing_pit[pit_choice][i]
-                self.drawing_pit[pit_choice][i] = 0
-                self.drawing_pit[5][i] = self.drawing_pit[5][i] + discarded_tile
-
-        return drawed_tiles
-
-    def insert_tiles_in_column(self, tile_type, drawed_tiles, column_choice, player):
-        number_of_drawed_tile = drawed_tiles
-
-        if (player == "P1"):
-            rows = self.rows_p1
-            scoreboard = self.board_p1
-        else:
-            rows = self.rows_p2
-            scoreboard = self.board_p2
+    def step(self, action):
+        """
+        Play an action and score the round when the pits are empty.
 
-        if (column_choice == 5):
-            self.insert_tiles_in_penalty_column(number_of_drawed_tile, player)
-            return
-
-        for i in range(column_choice + 1):
-
-                if (rows[column_choice][i] == 0 and number_of_drawed_tile > 0):
-                    rows[column_choice][i] = tile_type + 1
-                    number_of_drawed_tile = number_of_drawed_tile - 1
-
-                #mette le rimanenti nella penality column
-                self.insert_tiles_in_penalty_column(number_of_drawed_tile, player)
-
-    def insert_tiles_in_penalty_column(self, number_of_tiles, player):
-
-        if (player == "P1"):
-            penality_row = self.penalty_row_p1
-        else:
-            penality_row = self.penalty_row_p2
-
-        #se si riempie la penality column allora vanno scartate le tessere
-        for i in range(7):
-            if (penality_row[i] == 0 and number_of_tiles > 0):
-                penality_row[i] = 1
-
-                if (i < 2):
-                    self.penality_for_action = self.penality_for_action + 1                    
-                elif (i < 5):
-                    self.penality_for_action = self.penality_for_action + 2                    
-                else:
-                    self.penality_for_action = self.penality_for_action + 3
-                    
-                
-                number_of_tiles = number_of_tiles - 1
-
-    def calculate_score(self, player):
-
-        # calcolo dello score
-        if (player == "P1"):
-            rows = self.rows_p1
-
-        else:
-            rows = self.rows_p2
-
-        index_row = 0
-        for row in rows:
-            first_elem = row[0]
-            completed_row = True
-
-            for elem in row:
-                if (elem != first_elem or elem == 0):
-                    completed_row = False
-                    break
-
-            if (completed_row):
-                self.clear_row(index_row, player)
-                partial_score = self.add_tile_to_scoreboard(first_elem, player, index_row)
-                self.update_score(player, partial_score)
-
-            index_row = index_row + 1
-        # calculate penality
-        self.calculate_penality(player)
-
-    def clear_row(self, index_row, player):
-
-        if (player == "P1"):
-            rows = self.rows_p1
-        else:
-            rows = self.rows_p2
-
-        for i in range(index_row + 1):
-            rows[index_row][i] = 0
-
-    def add_tile_to_scoreboard(self, tile, player, index_row):
-
-        if (player == "P1"):
-            scoreboard = self.board_p1
-        else:
-            scoreboard = self.board_p2
-
-        index_column = ((tile - 1 + index_row) % 5)
-        scoreboard[index_row][index_column] = 1
-
-        # cambia nome metodi in adiacent
-        score_row = self.compute_row_point(index_row, index_column, player)
-        score_column = self.compute_column_point(index_row, index_column, player)
-
-        # 1 sta per l'inserimento della piastrella
-        return 1 + score_row + score_column
-
-    def compute_row_point(self, index_row, index_column, player):
-        if (player == "P1"):
-            scoreboard = self.board_p1
-        else:
-            scoreboard = self.board_p2
-        score = 0
-        i = 0
-        for elem in scoreboard[index_row]:
-            if (i < index_column):
-                if (elem):
-                    score = score + 1
-                else:
-                    score = 0
-            else:
-                if (elem):
-                    score = score + 1
-                else:
-                    break
-            i = i + 1
-        return score - 1
-
-    def compute_column_point(self, index_row, index_column, player):
-        if (player == "P1"):
-            scoreboard = self.board_p1
-        else:
-            scoreboard = self.board_p2
-        point = 0
-        i = 0
-        for row in scoreboard:
-
-            if (i < index_row):
-                if (row[index_column]):
-                    point = point + 1
-                else:
-                    point = 0
-            else:
-                if (row[index_column]):
-                    point = point + 1
-                else:
-                    break
-
-            i = i + 1
-        return point - 1
-
-    def calculate_penality(self, player):
-        if (player == "P1"):
-            penality_row = self.penalty_row_p1
-        else:
-            penality_row = self.penalty_row_p2
-        penality = 0
-
-        for i in range(7):
-            if (penality_row[i]):
-                if (i < 2):
-                    penality = penality - 1
-                elif (i < 5):
-                    penality = penality - 2
-                else:
-                    penality = penality - 3
-
-        self.update_score(player, penality)
-
-    def update_score(self, player, points):
-
-        if (player == "P1"):
-            if (self.p1_score + points > 0):
-                self.p1_score = self.p1_score + points
-            else:
-                self.p1_score = 0
-        else:
-            if (self.p2_score + points > 0):
-                self.p2_score = self.p2_score + points
+        Returns:
+            The reward and a boolean if the game has ended.
+        """
+        self.play(action)
+
+        self.round_ended = not self.factories.any()
+        if self.round_ended:
+            for player in range(2):
+                self.score_round(player)
+            if self.walls.all(axis=2).any():
+                self.info[self.GAMEOVER] = 1
+                for player in range(2):
+                    self.add_score(player, self.final_points(player))
             else:
-                self.p2_score = 0
-
-    def valid_actions(self,player):
-        valid_actions = []
-        for i in range(6):
-            for j in range(5):
-                for k in range(6):
-                    if(self.valid_move(player, i, j, k)):
-                        valid_actions.append([i,j,k])
-        return valid_actions
-
-    def is_turn_done(self):
-        for pit in self.drawing_pit:
-            for tile_type in pit:
-                if(tile_type != 0):
-                    self.is_done_phase = False
-                    return
-
-        self.is_done_phase = True
-        return
-
-    def is_game_done(self):
-        #controlla la board p1
-        self.is_turn_done()
-        if self.is_done_phase:
-            for row in self.board_p1:
-                completed_tiles_in_a_row = 0
-                for tile in row:
-                    completed_tiles_in_a_row = completed_tiles_in_a_row + tile
-                if(completed_tiles_in_a_row == 5):
-                    self.gameover = True
-                    return
-
-            # controlla la board p2
-            for row in self.board_p2:
-                completed_tiles_in_a_row = 0
-                for tile in row:
-                    completed_tiles_in_a_row = completed_tiles_in_a_row + tile
-                if (completed_tiles_in_a_row == 5):
-                    self.gameover = True
-                    return
-
-            self.gameover = False
-            return
-        else : return False
-
-    def traduci_azione(self,action):
-
-        #traduce l'azione da 180 a 6,6,5
-        action_pit_choice = action % 6
-        action_tile_type = int(action / 6 % 5)
-        action_column_choice = int(((action / 6) % 6))
-
-        return action_pit_choice , action_tile_type ,action_column_choice
-
-    def compute_final_points(self):
-        def row_completed_score(scoreboard):
-            row_completed = 0
-            for row in scoreboard:
-                n_tile_in_a_row = 0
-                for tile in row:
-                    if(tile == 1):
-                        n_tile_in_a_row = n_tile_in_a_row +1
-                if(n_tile_in_a_row == 5):
-                    row_completed = row_completed + 1
-            return row_completed * 2
-        def column_completed_score(scoreboard):
-            column_completed = 0
-            cumulative = [0,0,0,0,0]
-
-            for row in scoreboard:
-                cumulative = cumulative + row
-            for elem in cumulative:
-                if(elem == 5):
-                    column_completed = column_completed + 1
-            return column_completed * 5
-
-        def tile_completed_score(scoreboard):
-            tile_completed = 0
-            tile_array = [0,0,0,0,0]
-            for i in range(5):
-                for j in range(5):
-                    if(scoreboard[i][j] == 1):
-                        tile_array[(i+j) % 5] = tile_array[(i+j) % 5] + 1
-            for elem in tile_array:
-                if(elem == 5):
-                    tile_completed = tile_completed + 1
-            return tile_completed *7
-
-
-        #calcola per P1
-        scoreboard = self.board_p1
-        self.p1_score = self.p1_score + row_completed_score(scoreboard) + column_completed_score(scoreboard) + tile_completed_score(scoreboard)
-        #calcola per P2
-        scoreboard = self.board_p2
-        self.p2_score = self.p2_score + row_completed_score(scoreboard) + column_completed_score(scoreboard) + tile_completed_score(scoreboard)
-
-    def traduci_azione(action):
-
-        action_pit_choice = 0
-        action_tile_type = 0
-        action_column_choice = 0
-
-        if action < 6 :
-            action_pit_choice = action
-            return action_pit_choice, action_tile_type, action_column_choice
-
-        if action < 30 :
-            action_pit_choice = action % 6
-            action_tile_type = int(action / 6)
-            return action_pit_choice, action_tile_type, action_column_choice
-
-        action_pit_choice = action % 6
-        action_tile_type = int(( action % (6 * 5)) / 6)
-        action_column_choice = int(action / (6 * 5))
-
-        return action_pit_choice, action_tile_type, action_column_choice
-
-    def traduci_azione2(action_pit_choice ,action_tile_type ,action_column_choice):
-
-        a = action_pit_choice
-        b = action_tile_type
-        c = action_column_choice
-
-        return action_pit_choice + action_tile_type * 6 + action_column_choice * 6 * 5
-
-
-    def print_table(self):
-
-        print(f"P1:{self.p1_score}")
-        print(self.board_p1)
-        print(f"row_p1:{self.rows_p1}")
-        print(f"penality:{self.penalty_row_p1}")
-        print("=" * 20)
-        print(f"P2:{self.p2_score}")
-        print(self.board_p2)
-        print(f"row_p2:{self.rows_p2}")
-        print(f"penality:{self.penalty_row_p2}")
-        print("=" * 20)
-        print(self.drawing_pit)
-        print("=" * 20)
+                self.fill_factories()
+        self.update_legal_mask()
+
+        return 1 - 0.1 * self.penalty_for_action, self.is_gameover()
+
+    def score_round(self, player):
+        # Move the tiles of the complete pattern lines to the wall
+        for row in range(5):
+            if self.line_counts[player, row] == row + 1:
+                column = self.wall_columns[self.line_colors[player, row] - 1, row]
+                self.walls[player, row, column] = 1
+                self.line_colors[player, row] = 0
+                self.line_counts[player, row] = 0
+                self.update_row_accepts(player, row)
+                self.add_score(player, self.tile_points(player, row, column))
+        self.add_score(player, -int(self.penalty_points[self.penalties[player]]))
+
+    def tile_points(self, player, row, column):
+        # 1 for the tile plus the tiles adjacent to it in its row and in its column
+        wall = self.walls[player]
+        return (
+            self.run_length(wall[row], column) + self.run_length(wall[:, column], row) - 1
+        )
+
+    @staticmethod
+    def run_length(line, index):
+        start = index
+        while 0 < start and line[start - 1]:
+            start -= 1
+        end = index + 1
+        while end < len(line) and line[end]:
+            end += 1
+        return end - start
+
+    def final_points(self, player):
+        # 2 points per complete row, 5 per complete column and 7 per complete color
+        wall = self.walls[player].astype(bool)
+        colors = wall[np.arange(5)[None, :], self.wall_columns]
+        return int(
+            2 * wall.all(axis=1).sum()
+            + 5 * wall.all(axis=0).sum()
+            + 7 * colors.all(axis=1).sum()
+        )
+
+    def add_score(self, player, points):
+        self.scores[player] = max(int(self.scores[player]) + points, 0)
+
+    def pattern_lines(self, player):
+        """
+        Pattern lines as a 5x5 array with tile + 1 in the filled cells.
+        """
+        return np.where(
+            np.arange(5)[None, :] < self.line_counts[player][:, None],
+            self.line_colors[player][:, None],
+            0,
+        )
 
-    def game_to_string(self):
+    def penalty_row(self, player):
+        return [1 if slot < self.penalties[player] else 0 for slot in range(7)]
 
+    def game_to_string(self):
         board_str = ""
-        board_str += f"P1:{self.p1_score}" + "\n"
-        board_str += f"{self.board_p1}" + "\n"
-        board_str += f"row_p1:{self.rows_p1}" + "\n"
-        board_str += f"penality:{self.penalty_row_p1}" + "\n"
-        board_str += "=" * 20 + "\n"
-        board_str += f"P2:{self.p2_score}" + "\n"
-        board_str += f"{self.board_p2}" + "\n"
-        board_str += f"row_p2:{self.rows_p2}" + "\n"
-        board_str += f"penality:{self.penalty_row_p2}" + "\n"
-        board_str += "=" * 20 + "\n"
-        board_str += f"{self.drawing_pit}" + "\n"
+        for player in range(2):
+            board_str += f"P{player + 1}:{self.scores[player]}" + "\n"
+            board_str += f"{self.walls[player]}" + "\n"
+            board_str += f"row_p{player + 1}:{self.pattern_lines(player).tolist()}" + "\n"
+            board_str += f"penality:{self.penalty_row(player)}" + "\n"
+            board_str += "=" * 20 + "\n"
+        board_str += f"{self.factories.tolist()}" + "\n"
         board_str += "=" * 20 + "\n"
 
         return board_str
 
-class Azul:
-
-    def __init__(self):
-        self.game = Azul_game()
-        self.player = 0 if self.game.play_turn == "P1" else 1
-        
-        #ToDO board azul
-        self.board = self.board_to_obs()
-
-    def board_to_obs(self):
-
-        # processo per p1 ----------------------------------------------
-        lst_penality_p1_and_score = self.game.penalty_row_p1 + [0, self.game.p1_score]
 
-        np_penality_p1_and_score = np.array(lst_penality_p1_and_score)
-        np_penality_p1_and_score.resize(5, 2)
-        pd_penality_p1_and_score = pd.DataFrame(np_penality_p1_and_score)
-
-        pd_row_p1 = pd.DataFrame(self.game.rows_p1).fillna(0)
-        row_p1_with_penality_and_score = pd.concat([pd_row_p1, pd_penality_p1_and_score], axis=1).to_numpy().astype(int)
-
-        #stesso processo per p2
-        lst_penality_p2_and_score = self.game.penalty_row_p2 + [0, self.game.p2_score]
-
-        np_penality_p2_and_score = np.array(lst_penality_p2_and_score)
-        np_penality_p2_and_score.resize(5, 2)
-        pd_penality_p2_and_score = pd.DataFrame(np_penality_p2_and_score)
-
-        pd_row_p2 = pd.DataFrame(self.game.rows_p2).fillna(0)
-        row_p2_with_penality_and_score = pd.concat([pd_row_p2, pd_penality_p2_and_score], axis=1).to_numpy().astype(int)
+class Azul:
 
-        ###------------------------------------------------------------####
-        #common pit
+    # Cells of the 7 penalty slots in the last two columns of a player plane
+    penalty_cells = (np.arange(7) // 2, 10 + np.arange(7) % 2)
 
-        pd_drawing_pit = pd.DataFrame(self.game.drawing_pit)
-        pd_drawing_pit_trapsposte = pd_drawing_pit.transpose()
-        #pd_drawing_pit_trapsposte.loc[len(pd_drawing_pit_trapsposte)] = 0
-        zero_col =[7,8,9,10,11]
-        for colum in zero_col:
-            pd_drawing_pit_trapsposte[colum] = 0
-        complete_board_common_pit = pd_drawing_pit_trapsposte.to_numpy()
-        
+    def __init__(self, seed=None, observation_shape=(3, 5, 12)):
+        self.game = AzulEngine(seed)
+        self.player = self.game.to_play()
 
-        #-------------------------#
-        
-        #complete_board = []
-        complete_board_p1 = np.concatenate([self.game.board_p1,row_p1_with_penality_and_score], axis=1)
-        complete_board_p2 = np.concatenate([self.game.board_p2,row_p2_with_penality_and_score], axis=1)
+        # Observation updated in place after each move, a copy of it is returned
+        self.board = np.zeros(observation_shape, dtype=np.int8)
+        self.board_to_obs()
 
-        #complete_board_playes =  np.concatenate([complete_board_p1,complete_board_p2], axis=1)     
-        #complete_board =  np.concatenate([complete_board_playes,complete_board_common_pit], axis=1)
+    def board_to_obs(self, players=(0, 1)):
+        """
+        Write the planes of the given players and the plane of the pits in the observation.
 
-        return [complete_board_p1,complete_board_p2,complete_board_common_pit]
+        A player plane has the wall in the columns 0-4 and the pattern lines in 5-9. The
+        columns 10-11 hold the penalty row, then a 0 and the score, two cells per row.
+        The pits plane has the number of tiles of each color (row) in each pit (column).
+        """
+        for player in players:
+            plane = self.board[player]
+            plane[:, :5] = self.game.walls[player]
+            plane[:, 5:10] = self.game.pattern_lines(player)
+            plane[self.penalty_cells] = np.arange(7) < self.game.penalties[player]
+            # Scores above 127 do not fit in int8
+            plane[4, 10] = min(self.game.scores[player], 127)
+        self.board[2, :, :6] = self.game.factories.T
+
+    def snapshot(self):
+        return self.game.snapshot(), self.board.copy()
+
+    def restore(self, snapshot):
+        game_snapshot, board = snapshot
+        self.game.restore(game_snapshot)
+        self.board[:] = board
+        self.player = self.game.to_play()
+
+    def clone(self):
+        env = copy.copy(self)
+        env.game = self.game.clone()
+        env.board = self.board.copy()
+        return env
 
     def to_play(self):
-        return 0 if self.game.play_turn == "P1" else 1
+        return self.game.to_play()
 
     def reset(self):
-        #ToDO taglia in slice il game 
-        self.game = Azul_game()
-        
-        #ToDO board azul 
-        self.board = self.board_to_obs()
-        self.player = 0 if self.game.play_turn == "P1" else 1
+        self.game.reset()
+
+        self.board_to_obs()
+        self.player = self.game.to_play()
         return self.get_observation()
 
     def step(self, action):
-        #traduci azione da 14 a [1,2,3]
-        action_pit_choice , action_tile_type ,action_column_choice = self.game.traduci_azione(action)
-        #fai azione
-        self.game.play_turn(self.game.player_turn,action_pit_choice , action_tile_type ,action_column_choice)
-
-        self.game.is_done_phase()
-        self.game.is_game_done()
-
-        #controlla se è finito il turno
-        #controlla se è finita la partita
-
-        if(self.game.is_done_phase):
-
-            self.game.calculate_score("P1")
-            self.game.calculate_score("P2")
-
-            if(self.game.gameover):
-                self.game.compute_final_points()
-
-            else:
-                
-                self.game.create_drawing_pit()
-
-       
-        #reward
-        #prossimo player
-
-        done = self.have_winner()
-
-        reward = 1 + self.game.penality_for_action * -0.1
-
-        self.player = 0 if self.game.play_turn == "P1" else 1
+        player = self.game.to_play()
+        reward, done = self.game.step(action)
+        # Only the player who moved and the pits change, unless the round was scored
+        self.board_to_obs((0, 1) if self.game.round_ended else (player,))
+        self.player = self.game.to_play()
 
         return self.get_observation(), reward, done
 
-    def get_observation(self):  
-        return self.board_to_obs()
+    def get_observation(self):
+        return self.board.copy()
 
     def legal_actions(self):
-        legal = []
-        legal = self.game.valid_actions("P1" if self.player == 0 else "P2")
-        return legal
+        return self.game.legal_actions()
+
+    def legal_actions_mask(self):
+        return self.game.legal_actions_mask()
 
     def have_winner(self):
-        return self.game.gameover
+        return self.game.is_gameover()
 
 
 
     def expert_action(self):
 
         #random_player
-        actions = []
-        actions = self.azul_board.valid_actions("P2")
-        random.shuffle(actions)
-        tuple_action = actions.pop()
-        action = traduci_azione2(tuple_action[0],tuple_action[1],tuple_action[2])
-
-        return action
+        return random.choice(self.legal_actions())
 
     def render(self):
-        self.game.print_table()
\ No newline at end of file
+        print(self.game.game_to_string())
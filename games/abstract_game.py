@@ -46,6 +46,18 @@ class AbstractGame(ABC):
         """
         pass
 
+    def legal_actions_mask(self):
+        """
+        Optional: boolean mask of the legal actions over the action space, for games which
+        maintain it. The root of the search is then masked with it instead of legal_actions.
+
+        Returns:
+            A boolean array of the length of the action space, or None to use legal_actions.
+            The array can be the one maintained by the game, it is only valid until the
+            next step or reset.
+        """
+        return None
+
     @abstractmethod
     def reset(self):
         """
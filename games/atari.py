@@ -36,9 +36,15 @@ class MuZeroConfig:
 
         ### Self-Play
         self.num_workers = 350  # Number of simultaneous threads/workers self-playing to feed the replay buffer
+        self.games_per_worker = 1  # Number of games played in lockstep by each self-play worker, their searches are batched together in the network calls (VectorSelfPlay). 1 plays one game at a time (SelfPlay)
+        self.use_inference_server = False  # Evaluate the network of the self-play and reanalyse workers in a single InferenceServer actor which batches their requests
+        self.inference_batch_size = 64  # Maximum number of positions evaluated together by the InferenceServer
+        self.inference_max_latency = 0.002  # Maximum number of seconds a request waits for its batch to be filled
         self.selfplay_on_gpu = False
+        self.inference_backend = "torch"  # "torch" (float32), "quantized" (int8, dynamic for the Linear layers and static for the convolutions, slower than "torch" for small models and less accurate, only worth trying for wide resnet models) or "onnx" (ONNX Runtime, needs onnx and onnxruntime) network of the self-play and reanalyse actors running on the CPU
         self.max_moves = 27000  # Maximum number of moves if game is not finished before
         self.num_simulations = 50  # Number of future moves self-simulated
+        self.mcts_batch_size = 1  # Number of leaves selected with a virtual loss and evaluated in a single recurrent_inference call at each round of the MCTS. 1 keeps the sequential search
         self.discount = 0.997  # Chronological discount of the reward
         self.temperature_threshold = None  # Number of moves before dropping the temperature given by visit_softmax_temperature_fn to 0 (ie selecting the best action). If None, visit_softmax_temperature_fn is used every time
 
@@ -82,9 +88,13 @@ class MuZeroConfig:
         self.save_model = True  # Save the checkpoint in results_path as model.checkpoint
         self.training_steps = int(1000e3)  # Total number of training steps (ie weights update according to a batch)
         self.batch_size = 1024  # Number of parts of games to train on at each training step
+        self.prefetch_batches = 2  # Number of batches requested in advance by the trainer so that one is always ready
+        self.num_batch_builders = 0  # Number of actors assembling batches in parallel from the games the replay buffer publishes in the object store. 0 lets the replay buffer assemble them
         self.checkpoint_interval = int(1e3)  # Number of training steps before using the model for self-playing
         self.value_loss_weight = 0.25  # Scale the value loss to avoid overfitting of the value function, paper recommends 0.25 (See paper appendix Reanalyze)
         self.train_on_gpu = torch.cuda.is_available()  # Train on GPU if available
+        self.training_precision = "float32"  # "float32" or "bfloat16" to train under bfloat16 autocast, on CPU as well as on GPU
+        self.compile_training_step = False  # Compile the unrolled training step and loss with torch.compile (needs a working torch.compile backend)
 
         self.optimizer = "SGD"  # "Adam" or "SGD". Paper uses SGD
         self.weight_decay = 1e-4  # L2 weights regularization
@@ -0,0 +1,128 @@
+import asyncio
+
+import numpy
+import ray
+import torch
+
+import models
+
+
+@ray.remote
+class InferenceServer:
+    """
+    Class which run in a dedicated thread to evaluate the network for all the self-play
+    and reanalyse workers. The requests are gathered in batches, a batch is evaluated
+    when it holds inference_batch_size positions or when its first request has waited
+    inference_max_latency seconds.
+    """
+
+    def __init__(self, initial_checkpoint, config):
+        self.config = config
+
+        # Fix random generator seed
+        torch.manual_seed(self.config.seed)
+
+        # Initialize the network
+        self.model = models.inference_network(
+            self.config,
+            torch.device("cuda" if self.config.selfplay_on_gpu else "cpu"),
+        )
+        self.model.set_weights(initial_checkpoint["weights"])
+        self.weights_version = initial_checkpoint["weights_version"]
+
+        self.batches = {"initial_inference": [], "recurrent_inference": []}
+
+    async def continuous_update_weights(self, shared_storage):
+        """
+        Load the weights of every new checkpoint of the trainer.
+        """
+        update = 0
+        while True:
+            update, _ = await shared_storage.wait_for_update.remote(
+                "weights_version", update
+            )
+            if await shared_storage.get_info.remote("terminate"):
+                break
+            version, weights = await shared_storage.get_weights.remote(
+                self.weights_version
+            )
+            if weights:
+                self.model.set_weights(await weights[0])
+                self.weights_version = version
+
+    async def initial_inference(self, observation):
+        return await self.evaluate("initial_inference", (observation,))
+
+    async def recurrent_inference(self, encoded_state, action):
+        return await self.evaluate("recurrent_inference", (encoded_state, action))
+
+    async def evaluate(self, function, inputs):
+        batch = self.batches[function]
+        result = asyncio.get_running_loop().create_future()
+        batch.append((inputs, result))
+
+        if self.config.inference_batch_size <= sum(
+            len(inputs[0]) for inputs, _ in batch
+        ):
+            self.flush(function, batch)
+        elif len(batch) == 1:
+            asyncio.get_running_loop().call_later(
+                self.config.inference_max_latency, self.flush, function, batch
+            )
+
+        return await result
+
+    def flush(self, function, batch):
+        # The batch could have been evaluated before its deadline because it was full
+        if self.batches[function] is not batch:
+            return
+        self.batches[function] = []
+
+        try:
+            device = models.get_device(self.model)
+            inputs = [
+                torch.from_numpy(numpy.concatenate(batch_inputs)).to(device)
+                for batch_inputs in zip(*(inputs for inputs, _ in batch))
+            ]
+            with torch.no_grad():
+                outputs = [
+                    output.cpu().numpy()
+                    for output in getattr(self.model, function)(*inputs)
+                ]
+        except Exception as error:
+            # The event loop only logs the errors of a delayed flush, the requests of the
+            # batch raise the error instead of waiting forever
+            for _, result in batch:
+                if not result.done():
+                    result.set_exception(error)
+            return
+
+        # Send back to each request its part of the batch
+        start = 0
+        for inputs, result in batch:
+            end = start + len(inputs[0])
+            result.set_result(tuple(output[start:end] for output in outputs))
+            start = end
+
+
+class InferenceClient:
+    """
+    Stand-in for the network of a worker which forwards its calls to an InferenceServer.
+    """
+
+    def __init__(self, inference_server):
+        self.inference_server = inference_server
+
+    def initial_inference(self, observation):
+        return self.evaluate(self.inference_server.initial_inference, observation)
+
+    def recurrent_inference(self, encoded_state, action):
+        return self.evaluate(
+            self.inference_server.recurrent_inference, encoded_state, action
+        )
+
+    @staticmethod
+    def evaluate(method, *inputs):
+        outputs = ray.get(method.remote(*(x.cpu().numpy() for x in inputs)))
+        # Arrays coming from the object store are read only
+        return tuple(torch.tensor(output) for output in outputs)
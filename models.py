@@ -1,4 +1,9 @@
+import collections
+import copy
+import functools
+import io
 import math
+import warnings
 from abc import ABC, abstractmethod
 
 import torch
@@ -41,6 +46,278 @@ class MuZeroNetwork:
             )
 
 
+class MuZeroInferenceNetwork:
+    """
+    Inference only version of MuZeroNetwork for the actors evaluating positions on the CPU.
+    The sub-networks are unwrapped from DataParallel, the BatchNorm layers are fused in
+    the convolutions before them and the calls run in inference mode. The weights of the
+    trainer (with the "module." prefix of DataParallel) are loaded in a regular network,
+    the optimized copy is rebuilt at each set_weights.
+    """
+
+    def __init__(self, config):
+        self.network = MuZeroNetwork(config)
+        self.network.eval()
+        self.model = self.optimize()
+
+    def optimize(self):
+        return optimize_for_inference(self.network)
+
+    def initial_inference(self, observation):
+        with torch.inference_mode():
+            return self.model.initial_inference(observation)
+
+    def recurrent_inference(self, encoded_state, action):
+        with torch.inference_mode():
+            return self.model.recurrent_inference(encoded_state, action)
+
+    def get_weights(self):
+        return self.network.get_weights()
+
+    def set_weights(self, weights):
+        self.network.set_weights(weights)
+        self.model = self.optimize()
+
+
+class MuZeroQuantizedNetwork(MuZeroInferenceNetwork):
+    """
+    Int8 version of MuZeroInferenceNetwork. The Linear layers of the mlp are dynamically
+    quantized and the convolutions of the resnet statically quantized, their activation
+    ranges are calibrated on the last observations evaluated and on the hidden states
+    unrolled from them. The convolutions stay in float until the first observation is
+    evaluated, the quantized copy is rebuilt and calibrated again at each set_weights.
+
+    Quantizing and dequantizing around each layer costs more than the int8 arithmetic
+    saves on the small models of the games, it is slower than the float network for
+    them and only pays off for wide resnet models. The int8 outputs are less accurate,
+    the policy can differ from the one of the float network.
+    """
+
+    def __init__(self, config):
+        self.action_space_size = len(config.action_space)
+        self.calibration_steps = config.num_unroll_steps
+        # Last observation batches evaluated, to calibrate the convolutions
+        self.calibration_observations = collections.deque(maxlen=16)
+        super().__init__(config)
+
+    def optimize(self):
+        return quantize_for_inference(
+            self.network,
+            list(self.calibration_observations),
+            self.action_space_size,
+            self.calibration_steps,
+        )
+
+    def initial_inference(self, observation):
+        calibrate = not self.calibration_observations
+        self.calibration_observations.append(observation.clone())
+        if calibrate:
+            self.model = self.optimize()
+        return super().initial_inference(observation)
+
+
+class MuZeroOnnxNetwork(MuZeroInferenceNetwork):
+    """
+    Version of MuZeroInferenceNetwork evaluated by ONNX Runtime on its CPU execution
+    provider, which has a lower latency than torch on the small batches of the search.
+    The optimized network is exported to ONNX again at each set_weights.
+    """
+
+    def __init__(self, config):
+        # Shape of a batch of one stacked observation, to trace the network
+        self.observation_shape = (
+            1,
+            config.observation_shape[0] * (config.stacked_observations + 1)
+            + config.stacked_observations,
+        ) + tuple(config.observation_shape[1:])
+        super().__init__(config)
+
+    def optimize(self):
+        return OnnxModel(optimize_for_inference(self.network), self.observation_shape)
+
+
+class OnnxModel:
+    """
+    initial_inference and recurrent_inference of a network exported to ONNX with a
+    dynamic batch dimension, each in its ONNX Runtime session. onnx and onnxruntime are
+    imported only when this backend is used.
+    """
+
+    def __init__(self, network, observation_shape):
+        try:
+            import onnx  # noqa: F401 (needed by torch.onnx.export)
+            import onnxruntime
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError(
+                'Please install onnx and onnxruntime to use the "onnx" inference_backend.'
+            )
+
+        observation = torch.zeros(observation_shape)
+        with torch.no_grad():
+            _, _, _, encoded_state = network.initial_inference(observation)
+        action = torch.zeros((1, 1), dtype=torch.long)
+
+        options = onnxruntime.SessionOptions()
+        # As many threads as torch, the actors share the CPUs
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.sessions = {}
+        for function, inputs, input_names in (
+            ("initial_inference", (observation,), ["observation"]),
+            (
+                "recurrent_inference",
+                (encoded_state, action),
+                ["encoded_state", "action"],
+            ),
+        ):
+            output_names = ["value", "reward", "policy_logits", "next_encoded_state"]
+            onnx_model = io.BytesIO()
+            with warnings.catch_warnings():
+                # The constants of the network (like the reward of initial_inference)
+                # are expected in the trace
+                warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                torch.onnx.export(
+                    InferenceFunction(network, function),
+                    inputs,
+                    onnx_model,
+                    input_names=input_names,
+                    output_names=output_names,
+                    dynamic_axes={
+                        name: {0: "batch"} for name in input_names + output_names
+                    },
+                    dynamo=False,
+                )
+            self.sessions[function] = (
+                onnxruntime.InferenceSession(
+                    onnx_model.getvalue(), options, providers=["CPUExecutionProvider"]
+                ),
+                [
+                    (name, input.numpy().dtype)
+                    for name, input in zip(input_names, inputs)
+                ],
+            )
+
+    def initial_inference(self, observation):
+        return self.run("initial_inference", observation)
+
+    def recurrent_inference(self, encoded_state, action):
+        return self.run("recurrent_inference", encoded_state, action)
+
+    def run(self, function, *inputs):
+        session, input_types = self.sessions[function]
+        outputs = session.run(
+            None,
+            {
+                name: input.cpu().numpy().astype(dtype, copy=False)
+                for (name, dtype), input in zip(input_types, inputs)
+            },
+        )
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+
+class InferenceFunction(torch.nn.Module):
+    """
+    Module calling one of the inference functions of a network, to export it alone.
+    """
+
+    def __init__(self, network, function):
+        super().__init__()
+        self.network = network
+        self.function = function
+
+    def forward(self, *inputs):
+        return getattr(self.network, self.function)(*inputs)
+
+
+def inference_network(config, device):
+    """
+    Network of the actors which only evaluate positions (self-play, reanalyse, the
+    inference server and the diagnosis). On the CPU, a MuZeroInferenceNetwork or, with
+    the "quantized" or "onnx" inference_backend, a MuZeroQuantizedNetwork or a
+    MuZeroOnnxNetwork.
+    """
+    if config.inference_backend not in ("torch", "quantized", "onnx"):
+        raise NotImplementedError(
+            'The inference_backend parameter should be "torch", "quantized" or "onnx".'
+        )
+    if device.type == "cpu":
+        if config.inference_backend == "quantized":
+            return MuZeroQuantizedNetwork(config)
+        if config.inference_backend == "onnx":
+            return MuZeroOnnxNetwork(config)
+        return MuZeroInferenceNetwork(config)
+    model = MuZeroNetwork(config)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def optimize_for_inference(network):
+    """
+    Copy of a network in eval mode without DataParallel wrappers, with the BatchNorm layers
+    fused in the convolutions.
+    """
+    network = copy.deepcopy(network).eval()
+    for name, module in list(network.named_children()):
+        if isinstance(module, torch.nn.DataParallel):
+            setattr(network, name, module.module)
+
+    # Convolutions followed by a BatchNorm in ResidualBlock, RepresentationNetwork and
+    # DynamicsNetwork
+    for module in list(network.modules()):
+        for conv_name, bn_name in (("conv", "bn"), ("conv1", "bn1"), ("conv2", "bn2")):
+            conv = getattr(module, conv_name, None)
+            bn = getattr(module, bn_name, None)
+            if isinstance(conv, torch.nn.Conv2d) and isinstance(
+                bn, torch.nn.BatchNorm2d
+            ):
+                setattr(
+                    module,
+                    conv_name,
+                    torch.nn.utils.fusion.fuse_conv_bn_eval(conv, bn),
+                )
+                setattr(module, bn_name, torch.nn.Identity())
+    return network
+
+
+def quantize_for_inference(
+    network, calibration_observations, action_space_size, calibration_steps
+):
+    """
+    Copy of a network optimized with optimize_for_inference and quantized to int8: Linear
+    layers with dynamic quantization, convolutions with static quantization calibrated by
+    evaluating the observations and unrolling calibration_steps random actions from them.
+    Without calibration observations, the convolutions are not quantized.
+    """
+    network = optimize_for_inference(network)
+
+    if calibration_observations:
+        qconfig = torch.ao.quantization.get_default_qconfig(
+            torch.backends.quantized.engine
+        )
+        for module in list(network.modules()):
+            for name, child in list(module.named_children()):
+                if isinstance(child, torch.nn.Conv2d):
+                    # Quantize the input and dequantize the output of each convolution,
+                    # the normalizations and residual connections stay in float
+                    child = torch.ao.quantization.QuantWrapper(child)
+                    child.qconfig = qconfig
+                    setattr(module, name, child)
+        torch.ao.quantization.prepare(network, inplace=True)
+        with torch.no_grad():
+            for observation in calibration_observations:
+                _, _, _, hidden_state = network.initial_inference(observation)
+                for _ in range(calibration_steps):
+                    action = torch.randint(action_space_size, (len(observation), 1))
+                    _, _, _, hidden_state = network.recurrent_inference(
+                        hidden_state, action
+                    )
+        torch.ao.quantization.convert(network, inplace=True)
+
+    return torch.ao.quantization.quantize_dynamic(
+        network, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
 def dict_to_cpu(dictionary):
     cpu_dict = {}
     for key, value in dictionary.items():
@@ -53,6 +330,16 @@ def dict_to_cpu(dictionary):
     return cpu_dict
 
 
+def get_device(model):
+    """
+    Return the device expected for the inputs of a network. Evaluators which are not a
+    torch module (like inference_server.InferenceClient) take inputs on the CPU.
+    """
+    if isinstance(model, torch.nn.Module):
+        return next(model.parameters()).device
+    return torch.device("cpu")
+
+
 class AbstractNetwork(ABC, torch.nn.Module):
     def __init__(self):
         super().__init__()
@@ -138,7 +425,9 @@ class MuZeroFullyConnectedNetwork(AbstractNetwork):
         min_encoded_state = encoded_state.min(1, keepdim=True)[0]
         max_encoded_state = encoded_state.max(1, keepdim=True)[0]
         scale_encoded_state = max_encoded_state - min_encoded_state
-        scale_encoded_state[scale_encoded_state < 1e-5] += 1e-5
+        scale_encoded_state = torch.where(
+            scale_encoded_state < 1e-5, scale_encoded_state + 1e-5, scale_encoded_state
+        )
         encoded_state_normalized = (
             encoded_state - min_encoded_state
         ) / scale_encoded_state
@@ -162,7 +451,11 @@ class MuZeroFullyConnectedNetwork(AbstractNetwork):
         min_next_encoded_state = next_encoded_state.min(1, keepdim=True)[0]
         max_next_encoded_state = next_encoded_state.max(1, keepdim=True)[0]
         scale_next_encoded_state = max_next_encoded_state - min_next_encoded_state
-        scale_next_encoded_state[scale_next_encoded_state < 1e-5] += 1e-5
+        scale_next_encoded_state = torch.where(
+            scale_next_encoded_state < 1e-5,
+            scale_next_encoded_state + 1e-5,
+            scale_next_encoded_state,
+        )
         next_encoded_state_normalized = (
             next_encoded_state - min_next_encoded_state
         ) / scale_next_encoded_state
@@ -177,7 +470,7 @@ class MuZeroFullyConnectedNetwork(AbstractNetwork):
             (
                 torch.zeros(1, self.full_support_size)
                 .scatter(1, torch.tensor([[self.full_support_size // 2]]).long(), 1.0)
-                .repeat(len(observation), 1)
+                .repeat(observation.shape[0], 1)
                 .to(observation.device)
             )
         )
@@ -382,7 +675,7 @@ class DynamicsNetwork(torch.nn.Module):
             x = block(x)
         state = x
         x = self.conv1x1_reward(x)
-        x = x.view(-1, self.block_output_size_reward)
+        x = x.reshape(-1, self.block_output_size_reward)
         reward = self.fc(x)
         return state, reward
 
@@ -422,8 +715,8 @@ class PredictionNetwork(torch.nn.Module):
             x = block(x)
         value = self.conv1x1_value(x)
         policy = self.conv1x1_policy(x)
-        value = value.view(-1, self.block_output_size_value)
-        policy = policy.view(-1, self.block_output_size_policy)
+        value = value.reshape(-1, self.block_output_size_value)
+        policy = policy.reshape(-1, self.block_output_size_policy)
         value = self.fc_value(value)
         policy = self.fc_policy(policy)
         return policy, value
@@ -524,7 +817,7 @@ class MuZeroResidualNetwork(AbstractNetwork):
 
         # Scale encoded state between [0, 1] (See appendix paper Training)
         min_encoded_state = (
-            encoded_state.view(
+            encoded_state.reshape(
                 -1,
                 encoded_state.shape[1],
                 encoded_state.shape[2] * encoded_state.shape[3],
@@ -533,7 +826,7 @@ class MuZeroResidualNetwork(AbstractNetwork):
             .unsqueeze(-1)
         )
         max_encoded_state = (
-            encoded_state.view(
+            encoded_state.reshape(
                 -1,
                 encoded_state.shape[1],
                 encoded_state.shape[2] * encoded_state.shape[3],
@@ -542,7 +835,9 @@ class MuZeroResidualNetwork(AbstractNetwork):
             .unsqueeze(-1)
         )
         scale_encoded_state = max_encoded_state - min_encoded_state
-        scale_encoded_state[scale_encoded_state < 1e-5] += 1e-5
+        scale_encoded_state = torch.where(
+            scale_encoded_state < 1e-5, scale_encoded_state + 1e-5, scale_encoded_state
+        )
         encoded_state_normalized = (
             encoded_state - min_encoded_state
         ) / scale_encoded_state
@@ -570,7 +865,7 @@ class MuZeroResidualNetwork(AbstractNetwork):
 
         # Scale encoded state between [0, 1] (See paper appendix Training)
         min_next_encoded_state = (
-            next_encoded_state.view(
+            next_encoded_state.reshape(
                 -1,
                 next_encoded_state.shape[1],
                 next_encoded_state.shape[2] * next_encoded_state.shape[3],
@@ -579,7 +874,7 @@ class MuZeroResidualNetwork(AbstractNetwork):
             .unsqueeze(-1)
         )
         max_next_encoded_state = (
-            next_encoded_state.view(
+            next_encoded_state.reshape(
                 -1,
                 next_encoded_state.shape[1],
                 next_encoded_state.shape[2] * next_encoded_state.shape[3],
@@ -588,7 +883,11 @@ class MuZeroResidualNetwork(AbstractNetwork):
             .unsqueeze(-1)
         )
         scale_next_encoded_state = max_next_encoded_state - min_next_encoded_state
-        scale_next_encoded_state[scale_next_encoded_state < 1e-5] += 1e-5
+        scale_next_encoded_state = torch.where(
+            scale_next_encoded_state < 1e-5,
+            scale_next_encoded_state + 1e-5,
+            scale_next_encoded_state,
+        )
         next_encoded_state_normalized = (
             next_encoded_state - min_next_encoded_state
         ) / scale_next_encoded_state
@@ -602,7 +901,7 @@ class MuZeroResidualNetwork(AbstractNetwork):
             (
                 torch.zeros(1, self.full_support_size)
                 .scatter(1, torch.tensor([[self.full_support_size // 2]]).long(), 1.0)
-                .repeat(len(observation), 1)
+                .repeat(observation.shape[0], 1)
                 .to(observation.device)
             )
         )
@@ -644,14 +943,9 @@ def support_to_scalar(logits, support_size):
     See paper appendix Network Architecture
     """
     # Decode to a scalar
-    probabilities = torch.softmax(logits, dim=1)
-    support = (
-        torch.tensor([x for x in range(-support_size, support_size + 1)])
-        .expand(probabilities.shape)
-        .float()
-        .to(device=probabilities.device)
-    )
-    x = torch.sum(support * probabilities, dim=1, keepdim=True)
+    probabilities = torch.softmax(logits, dim=-1)
+    support = get_support(support_size, probabilities.device, probabilities.dtype)
+    x = probabilities @ support.unsqueeze(-1)
 
     # Invert the scaling (defined in https://arxiv.org/abs/1805.11593)
     x = torch.sign(x) * (
@@ -662,6 +956,36 @@ def support_to_scalar(logits, support_size):
     return x
 
 
+def support_to_scalars(logits, support_size):
+    """
+    Transform several categorical representations on the same support, like the value
+    and the reward, to scalars in a single decoding and a single transfer to the host.
+
+    Returns:
+        A numpy array with one row of scalars for each [batch, 2 * support_size + 1] logits.
+    """
+    return (
+        support_to_scalar(torch.stack(tuple(logits)), support_size)
+        .squeeze(-1)
+        .detach()
+        .cpu()
+        .numpy()
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_support(support_size, device, dtype):
+    """
+    Values of the categories of the support, built once per device.
+    """
+    # Not an inference tensor even if first built in inference mode, to be usable in
+    # the training graph
+    with torch.inference_mode(False):
+        return torch.arange(
+            -support_size, support_size + 1, dtype=dtype, device=device
+        )
+
+
 def scalar_to_support(x, support_size):
     """
     Transform a scalar to a categorical representation with (2 * support_size + 1) categories
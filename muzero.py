@@ -3,8 +3,11 @@ import importlib
 import math
 import os
 import pickle
+import shutil
 import sys
+import tempfile
 import time
+import weakref
 from glob import glob
 
 import nevergrad
@@ -14,6 +17,7 @@ import torch
 from torch.utils.tensorboard import SummaryWriter
 
 import diagnose_model
+import inference_server
 import models
 import replay_buffer
 import self_play
@@ -93,6 +97,7 @@ class MuZero:
         # Checkpoint and replay buffer used to initialize workers
         self.checkpoint = {
             "weights": None,
+            "weights_version": 0,
             "optimizer_state": None,
             "total_reward": 0,
             "muzero_reward": 0,
@@ -105,11 +110,16 @@ class MuZero:
             "value_loss": 0,
             "reward_loss": 0,
             "policy_loss": 0,
+            "data_wait_time": 0,
+            "training_steps_per_second": 0,
             "num_played_games": 0,
             "num_played_steps": 0,
             "num_reanalysed_games": 0,
             "terminate": False,
         }
+        # Directory of the replay buffer to continue, and games of a replay buffer pickled
+        # by previous versions to import
+        self.replay_buffer_path = None
         self.replay_buffer = {}
 
         cpu_actor = CPUActor.remote()
@@ -121,7 +131,9 @@ class MuZero:
         self.test_worker = None
         self.training_worker = None
         self.reanalyse_worker = None
+        self.inference_server_worker = None
         self.replay_buffer_worker = None
+        self.batch_builder_workers = None
         self.shared_storage_worker = None
 
     def train(self, log_in_tensorboard=True):
@@ -138,9 +150,16 @@ class MuZero:
         if 0 < self.num_gpus:
             num_gpus_per_worker = self.num_gpus / (
                 self.config.train_on_gpu
-                + self.config.num_workers * self.config.selfplay_on_gpu
+                + (
+                    1 if self.config.use_inference_server else self.config.num_workers
+                )
+                * self.config.selfplay_on_gpu
                 + log_in_tensorboard * self.config.selfplay_on_gpu
-                + self.config.use_last_model_value * self.config.reanalyse_on_gpu
+                + (
+                    self.config.use_last_model_value
+                    and not self.config.use_inference_server
+                )
+                * self.config.reanalyse_on_gpu
             )
             if 1 < num_gpus_per_worker:
                 num_gpus_per_worker = math.floor(num_gpus_per_worker)
@@ -159,30 +178,84 @@ class MuZero:
         )
         self.shared_storage_worker.set_info.remote("terminate", False)
 
+        # The games are written to a replay buffer directory of this training as they are
+        # played, the replay buffer to continue is copied in it. Trainings started in the
+        # same second, as in hyperparameter_search, share their results_path.
+        if self.config.save_model:
+            buffer_path = os.path.join(self.config.results_path, "replay_buffer")
+            suffix = 0
+            while True:
+                try:
+                    os.makedirs(buffer_path)
+                    break
+                except FileExistsError:
+                    suffix += 1
+                    buffer_path = os.path.join(
+                        self.config.results_path, f"replay_buffer_{suffix}"
+                    )
+        else:
+            # Without saving the model the replay buffer is only kept during the session
+            buffer_path = tempfile.mkdtemp(prefix="replay_buffer_")
+            weakref.finalize(self, shutil.rmtree, buffer_path, ignore_errors=True)
         self.replay_buffer_worker = replay_buffer.ReplayBuffer.remote(
-            self.checkpoint, self.replay_buffer, self.config
+            self.checkpoint,
+            buffer_path,
+            self.config,
+            self.replay_buffer,
+            self.replay_buffer_path,
         )
+        # A later training continues the games of this one
+        self.replay_buffer_path = buffer_path
+        self.replay_buffer = {}
+        self.batch_builder_workers = [
+            replay_buffer.BatchBuilder.options(num_cpus=0).remote(
+                self.config, self.config.seed + seed
+            )
+            for seed in range(self.config.num_batch_builders)
+        ]
 
-        if self.config.use_last_model_value:
-            self.reanalyse_worker = replay_buffer.Reanalyse.options(
+        # The self-play and reanalyse workers share the network of the inference server
+        if self.config.use_inference_server:
+            self.inference_server_worker = inference_server.InferenceServer.options(
                 num_cpus=0,
-                num_gpus=num_gpus_per_worker if self.config.reanalyse_on_gpu else 0,
+                num_gpus=num_gpus_per_worker if self.config.selfplay_on_gpu else 0,
             ).remote(self.checkpoint, self.config)
 
+        if self.config.use_last_model_value:
+            self.reanalyse_worker = replay_buffer.Reanalyse.options(
+                num_cpus=0,
+                num_gpus=num_gpus_per_worker
+                if self.config.reanalyse_on_gpu and not self.config.use_inference_server
+                else 0,
+            ).remote(self.checkpoint, self.config, self.inference_server_worker)
+
+        # Workers playing several games in lockstep batch the network calls of their searches
+        self_play_class = (
+            self_play.VectorSelfPlay
+            if 1 < self.config.games_per_worker
+            else self_play.SelfPlay
+        )
         self.self_play_workers = [
-            self_play.SelfPlay.options(
+            self_play_class.options(
                 num_cpus=0,
-                num_gpus=num_gpus_per_worker if self.config.selfplay_on_gpu else 0,
+                num_gpus=num_gpus_per_worker
+                if self.config.selfplay_on_gpu and not self.config.use_inference_server
+                else 0,
             ).remote(
                 self.checkpoint,
                 self.Game,
                 self.config,
                 self.config.seed + seed,
+                self.inference_server_worker,
             )
             for seed in range(self.config.num_workers)
         ]
 
         # Launch workers
+        if self.config.use_inference_server:
+            self.inference_server_worker.continuous_update_weights.remote(
+                self.shared_storage_worker
+            )
         [
             self_play_worker.continuous_self_play.remote(
                 self.shared_storage_worker, self.replay_buffer_worker
@@ -190,7 +263,9 @@ class MuZero:
             for self_play_worker in self.self_play_workers
         ]
         self.training_worker.continuous_update_weights.remote(
-            self.replay_buffer_worker, self.shared_storage_worker
+            self.replay_buffer_worker,
+            self.shared_storage_worker,
+            self.batch_builder_workers,
         )
         if self.config.use_last_model_value:
             self.reanalyse_worker.reanalyse.remote(
@@ -254,6 +329,8 @@ class MuZero:
             "value_loss",
             "reward_loss",
             "policy_loss",
+            "data_wait_time",
+            "training_steps_per_second",
             "num_played_games",
             "num_played_steps",
             "num_reanalysed_games",
@@ -311,6 +388,16 @@ class MuZero:
                     counter,
                 )
                 writer.add_scalar("2.Workers/6.Learning_rate", info["lr"], counter)
+                writer.add_scalar(
+                    "2.Workers/7.Trainer_data_wait_time",
+                    info["data_wait_time"],
+                    counter,
+                )
+                writer.add_scalar(
+                    "2.Workers/8.Training_steps_per_second",
+                    info["training_steps_per_second"],
+                    counter,
+                )
                 writer.add_scalar(
                     "3.Loss/1.Total_weighted_loss", info["total_loss"], counter
                 )
@@ -318,7 +405,7 @@ class MuZero:
                 writer.add_scalar("3.Loss/Reward_loss", info["reward_loss"], counter)
                 writer.add_scalar("3.Loss/Policy_loss", info["policy_loss"], counter)
                 print(
-                    f'Last test reward: {info["total_reward"]:.2f}. Training step: {info["training_step"]}/{self.config.training_steps}. Played games: {info["num_played_games"]}. Loss: {info["total_loss"]:.2f}',
+                    f'Last test reward: {info["total_reward"]:.2f}. Training step: {info["training_step"]}/{self.config.training_steps}. Played games: {info["num_played_games"]}. Loss: {info["total_loss"]:.2f}. Training steps/s: {info["training_steps_per_second"]:.1f}',
                     end="\r",
                 )
                 counter += 1
@@ -328,14 +415,6 @@ class MuZero:
 
         self.terminate_workers()
 
-        if self.config.save_model:
-            # Persist replay buffer to disk
-            print("\n\nPersisting replay buffer games to disk...")
-            pickle.dump(
-                self.replay_buffer,
-                open(os.path.join(self.config.results_path, "replay_buffer.pkl"), "wb"),
-            )
-
     def terminate_workers(self):
         """
         Softly terminate the running tasks and garbage collect the workers.
@@ -346,15 +425,17 @@ class MuZero:
                 self.shared_storage_worker.get_checkpoint.remote()
             )
         if self.replay_buffer_worker:
-            self.replay_buffer = ray.get(self.replay_buffer_worker.get_buffer.remote())
-
+            # The self-play workers can still send a game before they stop
+            ray.get(self.replay_buffer_worker.close.remote())
         print("\nShutting down workers...")
 
         self.self_play_workers = None
         self.test_worker = None
         self.training_worker = None
         self.reanalyse_worker = None
+        self.inference_server_worker = None
         self.replay_buffer_worker = None
+        self.batch_builder_workers = None
         self.shared_storage_worker = None
 
     def test(
@@ -421,19 +502,29 @@ class MuZero:
         Args:
             checkpoint_path (str): Path to model.checkpoint or model.weights.
 
-            replay_buffer_path (str): Path to replay_buffer.pkl
+            replay_buffer_path (str): Path to a replay_buffer directory, or to a
+            replay_buffer.pkl saved by previous versions.
         """
         # Load checkpoint
         if checkpoint_path:
             if os.path.exists(checkpoint_path):
                 self.checkpoint = torch.load(checkpoint_path)
+                # Checkpoints saved before the data wait time, the weights version and
+                # the training speed
+                self.checkpoint.setdefault("data_wait_time", 0)
+                self.checkpoint.setdefault("training_steps_per_second", 0)
+                self.checkpoint.setdefault("weights_version", 0)
                 print(f"\nUsing checkpoint from {checkpoint_path}")
             else:
                 print(f"\nThere is no model saved in {checkpoint_path}.")
 
         # Load replay buffer
         if replay_buffer_path:
-            if os.path.exists(replay_buffer_path):
+            if os.path.isdir(replay_buffer_path):
+                # The training copies this replay buffer and continues it
+                self.replay_buffer_path = replay_buffer_path
+                print(f"\nInitializing replay buffer with {replay_buffer_path}")
+            elif os.path.exists(replay_buffer_path):
                 with open(replay_buffer_path, "rb") as f:
                     self.replay_buffer = pickle.load(f)
                 print(f"\nInitializing replay buffer with {replay_buffer_path}")
@@ -461,6 +552,20 @@ class MuZero:
         input("Press enter to close all plots")
         dm.close_all()
 
+    def benchmark_inference_backend(self, num_positions=100, backend="quantized"):
+        """
+        Compare the policies, the MCTS actions and the simulations per second of an
+        inference backend with the float32 network on random positions of the game.
+
+        Args:
+            num_positions (int): Number of positions to search with each network.
+
+            backend (str): inference_backend to compare with the float32 network.
+        """
+        game = self.Game(self.config.seed)
+        dm = diagnose_model.DiagnoseModel(self.checkpoint, self.config)
+        return dm.compare_inference_backend(game, num_positions, backend)
+
 
 @ray.remote(num_cpus=0, num_gpus=0)
 class CPUActor:
@@ -586,13 +691,20 @@ def load_model_menu(muzero, game_name):
         while checkpoint_path and not os.path.isfile(checkpoint_path):
             checkpoint_path = input("Invalid checkpoint path. Try again: ")
         replay_buffer_path = input(
-            "Enter a path to the replay_buffer.pkl, or ENTER if none: "
+            "Enter a path to the replay_buffer directory or replay_buffer.pkl, or ENTER if none: "
         )
-        while replay_buffer_path and not os.path.isfile(replay_buffer_path):
+        while replay_buffer_path and not os.path.exists(replay_buffer_path):
             replay_buffer_path = input("Invalid replay buffer path. Try again: ")
     else:
         checkpoint_path = f"{options[choice]}model.checkpoint"
-        replay_buffer_path = f"{options[choice]}replay_buffer.pkl"
+        # The replay buffer of the last training of the results
+        replay_buffer_paths = glob(f"{options[choice]}replay_buffer*/index.bin")
+        if replay_buffer_paths:
+            replay_buffer_path = os.path.dirname(
+                max(replay_buffer_paths, key=os.path.getmtime)
+            )
+        else:
+            replay_buffer_path = f"{options[choice]}replay_buffer.pkl"
 
     muzero.load_model(
         checkpoint_path=checkpoint_path,
@@ -1,11 +1,14 @@
-import copy
-import time
+import json
+import os
+import shutil
 
 import numpy
 import ray
 import torch
 
 import models
+from inference_server import InferenceClient
+from self_play import GameHistory
 
 
 @ray.remote
@@ -14,14 +17,46 @@ class ReplayBuffer:
     Class which run in a dedicated thread to store played games and generate batch.
     """
 
-    def __init__(self, initial_checkpoint, initial_buffer, config):
+    def __init__(
+        self,
+        initial_checkpoint,
+        buffer_path,
+        config,
+        initial_games=None,
+        initial_buffer_path=None,
+    ):
         self.config = config
-        self.buffer = copy.deepcopy(initial_buffer)
-        self.num_played_games = initial_checkpoint["num_played_games"]
-        self.num_played_steps = initial_checkpoint["num_played_steps"]
-        self.total_samples = sum(
-            [len(game_history.root_values) for game_history in self.buffer.values()]
+        # The games are written to disk as they arrive, see GameStorage
+        self.buffer = GameStorage(buffer_path, self.config, initial_buffer_path)
+        if initial_games:
+            # Replay buffers pickled by previous versions are imported in the storage
+            self.buffer.skip(min(initial_games) - self.buffer.num_games)
+            for game_id in sorted(initial_games):
+                game_history = initial_games[game_id]
+                # Replay buffers saved before the histories were arrays hold lists
+                game_history.finalize()
+                game_history.target_values = self.compute_target_values(game_history)
+                self.init_priorities(game_history)
+                self.buffer.append(game_history)
+        # Game ids continue after the games of the checkpoint, the storage can also hold
+        # games played after the checkpoint was saved
+        self.buffer.skip(initial_checkpoint["num_played_games"] - self.buffer.num_games)
+        self.num_played_games = self.buffer.num_games
+        self.num_played_steps = initial_checkpoint["num_played_steps"] + int(
+            self.buffer.num_searches(
+                slice(initial_checkpoint["num_played_games"], None)
+            ).sum()
         )
+        if self.config.PER:
+            # Games are stored in the slot game_id % replay_buffer_size of the tree
+            self.game_priorities = SumTree(self.config.replay_buffer_size)
+            if len(self.buffer):
+                self.game_priorities.update(
+                    numpy.arange(self.buffer.first_game_id, self.buffer.num_games)
+                    % self.config.replay_buffer_size,
+                    self.buffer.game_priorities(),
+                )
+        self.total_samples = int(self.buffer.num_searches().sum())
         if self.total_samples != 0:
             print(
                 f"Replay buffer initialized with {self.total_samples} samples ({self.num_played_games} games).\n"
@@ -30,27 +65,20 @@ class ReplayBuffer:
         # Fix random generator seed
         numpy.random.seed(self.config.seed)
 
+        # Assemble the batches, the BatchBuilder actors read the games from the files
+        self.batch_assembler = BatchAssembler(self.config)
+        # Set at the end of the training, the storage takes no more games
+        self.closed = False
+
     def save_game(self, game_history, shared_storage=None):
-        if self.config.PER:
-            if game_history.priorities is not None:
-                # Avoid read only array when loading replay buffer from disk
-                game_history.priorities = numpy.copy(game_history.priorities)
-            else:
-                # Initial priorities for the prioritized replay (See paper appendix Training)
-                priorities = []
-                for i, root_value in enumerate(game_history.root_values):
-                    priority = (
-                        numpy.abs(
-                            root_value - self.compute_target_value(game_history, i)
-                        )
-                        ** self.config.PER_alpha
-                    )
-                    priorities.append(priority)
+        if self.closed:
+            return
 
-                game_history.priorities = numpy.array(priorities, dtype="float32")
-                game_history.game_priority = numpy.max(game_history.priorities)
+        game_history.target_values = self.compute_target_values(game_history)
+        # The priorities are stored with the game even without PER
+        self.init_priorities(game_history)
 
-        self.buffer[self.num_played_games] = game_history
+        self.buffer.append(game_history)
         self.num_played_games += 1
         self.num_played_steps += len(game_history.root_values)
         self.total_samples += len(game_history.root_values)
@@ -59,100 +87,113 @@ class ReplayBuffer:
             del_id = self.num_played_games - len(self.buffer)
             self.total_samples -= len(self.buffer[del_id].root_values)
             del self.buffer[del_id]
+            if self.config.PER:
+                self.game_priorities.update(del_id % self.config.replay_buffer_size, 0)
+
+        if self.config.PER:
+            self.game_priorities.update(
+                (self.num_played_games - 1) % self.config.replay_buffer_size,
+                game_history.game_priority,
+            )
 
         if shared_storage:
             shared_storage.set_info.remote("num_played_games", self.num_played_games)
             shared_storage.set_info.remote("num_played_steps", self.num_played_steps)
 
-    def get_buffer(self):
-        return self.buffer
+    def close(self):
+        """
+        Stop writing games to the storage, the games finished after the end of the
+        training are dropped. The directory can then be copied or removed.
+        """
+        self.closed = True
+
+    def init_priorities(self, game_history):
+        if game_history.priorities is not None:
+            # Avoid read only array when loading replay buffer from disk
+            game_history.priorities = numpy.copy(game_history.priorities)
+        else:
+            # Initial priorities for the prioritized replay (See paper appendix Training)
+            game_history.priorities = (
+                numpy.abs(game_history.root_values - game_history.target_values)
+                ** self.config.PER_alpha
+            ).astype("float32")
+        game_history.game_priority = numpy.max(game_history.priorities)
 
     def get_batch(self):
-        (
-            index_batch,
-            observation_batch,
-            action_batch,
-            reward_batch,
-            value_batch,
-            policy_batch,
-            gradient_scale_batch,
-        ) = ([], [], [], [], [], [], [])
-        weight_batch = [] if self.config.PER else None
-
-        for _ in range(self.config.batch_size):
-            game_id, game_history, game_prob = self.sample_game()
-            game_pos, pos_prob = self.sample_position(game_history)
-
-            values, rewards, policies, actions = self.make_target(
-                game_history, game_pos
-            )
+        game_ids, game_positions, probs = self.sample(self.config.batch_size)
+
+        return self.batch_assembler.assemble(
+            [self.buffer[game_id] for game_id in game_ids],
+            game_ids,
+            game_positions,
+            probs,
+            self.total_samples,
+        )
 
-            index_batch.append([game_id, game_pos])
-            observation_batch.append(
-                game_history.get_stacked_observations(
-                    game_pos, self.config.stacked_observations
-                )
-            )
-            action_batch.append(actions)
-            value_batch.append(values)
-            reward_batch.append(rewards)
-            policy_batch.append(policies)
-            gradient_scale_batch.append(
-                [
-                    min(
-                        self.config.num_unroll_steps,
-                        len(game_history.action_history) - game_pos,
-                    )
-                ]
-                * len(actions)
-            )
+    def sample_batch(self):
+        """
+        Sample the positions of a batch for a BatchBuilder, the games are sent as their
+        records in the index of the storage, to be read from the segment files.
+        """
+        game_ids, game_positions, probs = self.sample(self.config.batch_size)
+
+        return {
+            "game_ids": game_ids,
+            "game_positions": game_positions,
+            "probs": probs,
+            "total_samples": self.total_samples,
+            "buffer_path": self.buffer.path,
+            "records": self.buffer.index[game_ids],
+            "first_segment": min(self.buffer.segments),
+        }
+
+    def sample(self, batch_size):
+        """
+        Sample a batch of positions, games and positions are sampled either uniformly
+        or according to their priority. Return the game ids, the positions and the
+        probabilities to sample them (None without PER).
+        """
+        game_ids, game_probs = self.sample_game_ids(batch_size)
+        game_positions, probs = [], [] if self.config.PER else None
+        for i, game_id in enumerate(game_ids):
+            game_pos, pos_prob = self.sample_position(self.buffer[game_id])
+            game_positions.append(game_pos)
             if self.config.PER:
-                weight_batch.append(1 / (self.total_samples * game_prob * pos_prob))
+                probs.append(game_probs[i] * pos_prob)
 
-        if self.config.PER:
-            weight_batch = numpy.array(weight_batch, dtype="float32") / max(
-                weight_batch
+        return game_ids, game_positions, probs
+
+    def sample_game_ids(self, batch_size, force_uniform=False):
+        """
+        Sample batch_size game ids in O(log N) each with the sum tree of the game priorities.
+        """
+        first_game_id = self.buffer.first_game_id
+        game_probs = None
+        if self.config.PER and not force_uniform:
+            slots = self.game_priorities.sample(batch_size)
+            game_probs = (
+                self.game_priorities.get(slots) / self.game_priorities.total()
+            )
+            game_ids = (
+                first_game_id
+                + (slots - first_game_id) % self.config.replay_buffer_size
+            )
+        else:
+            game_ids = first_game_id + numpy.random.randint(
+                len(self.buffer), size=batch_size
             )
 
-        # observation_batch: batch, channels, height, width
-        # action_batch: batch, num_unroll_steps+1
-        # value_batch: batch, num_unroll_steps+1
-        # reward_batch: batch, num_unroll_steps+1
-        # policy_batch: batch, num_unroll_steps+1, len(action_space)
-        # weight_batch: batch
-        # gradient_scale_batch: batch, num_unroll_steps+1
-        return (
-            index_batch,
-            (
-                observation_batch,
-                action_batch,
-                value_batch,
-                reward_batch,
-                policy_batch,
-                weight_batch,
-                gradient_scale_batch,
-            ),
-        )
+        return game_ids.tolist(), game_probs
 
     def sample_game(self, force_uniform=False):
         """
         Sample game from buffer either uniformly or according to some priority.
         See paper appendix Training.
         """
-        game_prob = None
-        if self.config.PER and not force_uniform:
-            game_probs = numpy.array(
-                [game_history.game_priority for game_history in self.buffer.values()],
-                dtype="float32",
-            )
-            game_probs /= numpy.sum(game_probs)
-            game_index = numpy.random.choice(len(self.buffer), p=game_probs)
-            game_prob = game_probs[game_index]
-        else:
-            game_index = numpy.random.choice(len(self.buffer))
-        game_id = self.num_played_games - len(self.buffer) + game_index
+        game_ids, game_probs = self.sample_game_ids(1, force_uniform)
+        game_prob = game_probs[0] if game_probs is not None else None
 
-        return game_id, self.buffer[game_id], game_prob
+        return game_ids[0], self.buffer[game_ids[0]], game_prob
 
     def sample_position(self, game_history, force_uniform=False):
         """
@@ -161,9 +202,18 @@ class ReplayBuffer:
         """
         position_prob = None
         if self.config.PER and not force_uniform:
-            position_probs = game_history.priorities / sum(game_history.priorities)
-            position_index = numpy.random.choice(len(position_probs), p=position_probs)
-            position_prob = position_probs[position_index]
+            cumulative_priorities = numpy.cumsum(game_history.priorities)
+            position_index = min(
+                numpy.searchsorted(
+                    cumulative_priorities,
+                    numpy.random.uniform(0, cumulative_priorities[-1]),
+                    side="right",
+                ),
+                len(cumulative_priorities) - 1,
+            )
+            position_prob = (
+                game_history.priorities[position_index] / cumulative_priorities[-1]
+            )
         else:
             position_index = numpy.random.choice(len(game_history.root_values))
 
@@ -171,111 +221,720 @@ class ReplayBuffer:
 
     def update_game_history(self, game_id, game_history):
         # The element could have been removed since its selection and update
-        if next(iter(self.buffer)) <= game_id:
-            if self.config.PER:
-                # Avoid read only array when loading replay buffer from disk
-                game_history.priorities = numpy.copy(game_history.priorities)
-            self.buffer[game_id] = game_history
+        if self.buffer.first_game_id <= game_id:
+            # Reanalysed root values change the value targets, the priorities updated
+            # since the game was sampled are kept
+            game_history.target_values = self.compute_target_values(game_history)
+            self.buffer.update_values(game_id, game_history)
 
     def update_priorities(self, priorities, index_info):
         """
         Update game and position priorities with priorities calculated during the training.
         See Distributed Prioritized Experience Replay https://arxiv.org/abs/1803.00933
         """
+        # Without PER there is no sum tree of the game priorities
+        if not self.config.PER:
+            return
+
+        updated_game_ids = []
+        game_priorities = []
         for i in range(len(index_info)):
             game_id, game_pos = index_info[i]
 
             # The element could have been removed since its selection and training
-            if next(iter(self.buffer)) <= game_id:
-                # Update position priorities
+            if self.buffer.first_game_id <= game_id:
+                # Update position priorities, in the file of the game
+                game_history = self.buffer[game_id]
                 priority = priorities[i, :]
                 start_index = game_pos
-                end_index = min(
-                    game_pos + len(priority), len(self.buffer[game_id].priorities)
-                )
-                self.buffer[game_id].priorities[start_index:end_index] = priority[
+                end_index = min(game_pos + len(priority), len(game_history.priorities))
+                game_history.priorities[start_index:end_index] = priority[
                     : end_index - start_index
                 ]
 
                 # Update game priorities
-                self.buffer[game_id].game_priority = numpy.max(
-                    self.buffer[game_id].priorities
-                )
+                updated_game_ids.append(game_id)
+                game_priorities.append(numpy.max(game_history.priorities))
+
+        self.game_priorities.update(
+            numpy.array(updated_game_ids, dtype="int64")
+            % self.config.replay_buffer_size,
+            game_priorities,
+        )
+
+    def compute_target_values(self, game_history):
+        """
+        Compute the value targets of all the positions of a game at once.
+        """
+        root_values = numpy.array(
+            game_history.root_values
+            if game_history.reanalysed_predicted_root_values is None
+            else game_history.reanalysed_predicted_root_values,
+            dtype="float64",
+        )
+        rewards = numpy.array(game_history.reward_history, dtype="float64")
+        to_play = numpy.array(game_history.to_play_history)
+        positions = numpy.arange(len(root_values))
+        target_values = numpy.zeros(len(root_values))
 
-    def compute_target_value(self, game_history, index):
         # The value target is the discounted root value of the search tree td_steps into the
         # future, plus the discounted sum of all rewards until then.
-        bootstrap_index = index + self.config.td_steps
-        if bootstrap_index < len(game_history.root_values):
-            root_values = (
-                game_history.root_values
-                if game_history.reanalysed_predicted_root_values is None
-                else game_history.reanalysed_predicted_root_values
+        bootstrap_positions = positions + self.config.td_steps
+        bootstrapped = bootstrap_positions < len(root_values)
+        bootstrap_positions = bootstrap_positions[bootstrapped]
+        target_values[bootstrapped] = (
+            numpy.where(
+                to_play[bootstrap_positions] == to_play[positions[bootstrapped]],
+                root_values[bootstrap_positions],
+                -root_values[bootstrap_positions],
             )
-            last_step_value = (
-                root_values[bootstrap_index]
-                if game_history.to_play_history[bootstrap_index]
-                == game_history.to_play_history[index]
-                else -root_values[bootstrap_index]
+            * self.config.discount ** self.config.td_steps
+        )
+
+        # Rewards are in rows of td_steps, row i holds the rewards following position i
+        steps = numpy.arange(self.config.td_steps)
+        reward_positions = positions[:, None] + 1 + steps
+        in_game = reward_positions < len(rewards)
+        reward_positions = numpy.minimum(reward_positions, len(rewards) - 1)
+        # The value is oriented from the perspective of the current player
+        signs = numpy.where(
+            to_play[reward_positions - 1] == to_play[positions, None], 1, -1
+        )
+        target_values += numpy.sum(
+            in_game * signs * rewards[reward_positions] * self.config.discount ** steps,
+            axis=1,
+        )
+
+        return target_values
+
+
+class BatchAssembler:
+    """
+    Build the batches in arrays allocated once with the dtypes used by the training.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+        # The arrays are reused, Ray copies them to the object store when the batch is returned
+        channels, height, width = self.config.observation_shape
+        num_steps = self.config.num_unroll_steps + 1
+        self.observation_batch = numpy.zeros(
+            (
+                self.config.batch_size,
+                channels * (self.config.stacked_observations + 1)
+                + self.config.stacked_observations,
+                height,
+                width,
+            ),
+            dtype="float32",
+        )
+        self.action_batch = numpy.zeros(
+            (self.config.batch_size, num_steps), dtype="int64"
+        )
+        self.value_batch = numpy.zeros(
+            (self.config.batch_size, num_steps), dtype="float32"
+        )
+        self.reward_batch = numpy.zeros(
+            (self.config.batch_size, num_steps), dtype="float32"
+        )
+        self.policy_batch = numpy.zeros(
+            (self.config.batch_size, num_steps, len(self.config.action_space)),
+            dtype="float32",
+        )
+        self.weight_batch = numpy.zeros(self.config.batch_size, dtype="float32")
+        self.gradient_scale_batch = numpy.zeros(
+            (self.config.batch_size, num_steps), dtype="float32"
+        )
+
+    def assemble(
+        self, game_histories, game_ids, game_positions, probs, total_samples
+    ):
+        """
+        Fill the batch arrays with the sampled positions of the given games.
+        """
+        game_positions = numpy.array(game_positions)
+
+        # The observations and targets of all the samples of a game are gathered at once
+        rows_of_games = {}
+        for row, game_id in enumerate(game_ids):
+            rows_of_games.setdefault(game_id, []).append(row)
+        for rows in rows_of_games.values():
+            game_history = game_histories[rows[0]]
+            self.observation_batch[rows] = game_history.get_stacked_observations(
+                game_positions[rows], self.config.stacked_observations
             )
+            self.make_targets(game_history, game_positions[rows], rows)
+        # States past the end of games are treated as absorbing states, their actions
+        # are drawn in the order of the rows
+        past_end = self.action_batch == -1
+        self.action_batch[past_end] = numpy.random.choice(
+            self.config.action_space, numpy.count_nonzero(past_end)
+        )
 
-            value = last_step_value * self.config.discount ** self.config.td_steps
-        else:
-            value = 0
+        index_batch = numpy.stack((game_ids, game_positions), axis=1)
+        game_lengths = numpy.array(
+            [len(game_history.action_history) for game_history in game_histories]
+        )
+        self.gradient_scale_batch[:] = numpy.minimum(
+            self.config.num_unroll_steps, game_lengths - game_positions
+        )[:, None]
+        weight_batch = None
+        if self.config.PER:
+            weight_batch = self.weight_batch
+            weight_batch[:] = 1 / (total_samples * numpy.array(probs))
+            weight_batch /= weight_batch.max()
+
+        observation_batch = self.observation_batch
+        action_batch = self.action_batch
+        value_batch = self.value_batch
+        reward_batch = self.reward_batch
+        policy_batch = self.policy_batch
+        gradient_scale_batch = self.gradient_scale_batch
+
+        # observation_batch: batch, channels, height, width
+        # action_batch: batch, num_unroll_steps+1
+        # value_batch: batch, num_unroll_steps+1
+        # reward_batch: batch, num_unroll_steps+1
+        # policy_batch: batch, num_unroll_steps+1, len(action_space)
+        # weight_batch: batch
+        # gradient_scale_batch: batch, num_unroll_steps+1
+        return (
+            index_batch,
+            (
+                observation_batch,
+                action_batch,
+                value_batch,
+                reward_batch,
+                policy_batch,
+                weight_batch,
+                gradient_scale_batch,
+            ),
+        )
+
+    def make_targets(self, game_history, state_indexes, rows):
+        """
+        Generate targets for every unroll steps of the samples of a game, in the given
+        rows of the batch. The actions past the end of the game are left at -1.
+        """
+        indexes = state_indexes[:, None] + numpy.arange(
+            self.config.num_unroll_steps + 1
+        )
+        # The position right after the end of the game has a reward and an action but no search
+        searched = indexes < len(game_history.root_values)
+        played = indexes < len(game_history.action_history)
+        search_indexes = numpy.minimum(indexes, len(game_history.root_values) - 1)
+        play_indexes = numpy.minimum(indexes, len(game_history.action_history) - 1)
+
+        self.value_batch[rows] = numpy.where(
+            searched, game_history.target_values[search_indexes], 0
+        )
+        self.reward_batch[rows] = numpy.where(
+            played, game_history.reward_history[play_indexes], 0
+        )
+        # Uniform policy after the end of the game
+        self.policy_batch[rows] = numpy.where(
+            searched[..., None],
+            game_history.child_visits[search_indexes],
+            1 / len(self.config.action_space),
+        )
+        self.action_batch[rows] = numpy.where(
+            played, game_history.action_history[play_indexes], -1
+        )
+
+
+@ray.remote
+class BatchBuilder:
+    """
+    Class which run in a dedicated thread to assemble batches in parallel with the replay
+    buffer. The replay buffer samples the positions and the builders read the games from
+    the memory-mapped files of its storage, without copying them.
+    """
+
+    def __init__(self, config, seed):
+        self.config = config
+        self.batch_assembler = BatchAssembler(self.config)
+        self.step_fields, self.search_fields = GameStorage.fields(self.config)
+        # Segments already mapped, by segment id
+        self.segments = {}
+
+        # Fix random generator seed
+        numpy.random.seed(seed)
+
+    def get_batch(self, replay_buffer):
+        while True:
+            batch_info = ray.get(replay_buffer.sample_batch.remote())
+            for segment_id in [
+                segment_id
+                for segment_id in self.segments
+                if segment_id < batch_info["first_segment"]
+            ]:
+                del self.segments[segment_id]
+
+            try:
+                game_histories = [
+                    self.game_history(batch_info["buffer_path"], record)
+                    for record in batch_info["records"].tolist()
+                ]
+                break
+            except FileNotFoundError:
+                # A segment not mapped yet was deleted since the batch was sampled
+                if not os.path.isdir(batch_info["buffer_path"]):
+                    raise
+
+        return self.batch_assembler.assemble(
+            game_histories,
+            batch_info["game_ids"],
+            batch_info["game_positions"],
+            batch_info["probs"],
+            batch_info["total_samples"],
+        )
+
+    def game_history(self, buffer_path, record):
+        segment_id, step_offset, num_steps, search_offset, num_searches = record
+        if segment_id not in self.segments:
+            self.segments[segment_id] = GameSegment(
+                os.path.join(buffer_path, f"segment_{segment_id:06d}"),
+                self.step_fields,
+                self.search_fields,
+            )
+        segment = self.segments[segment_id]
+        # The files grew since they were mapped
+        segment.map_rows(step_offset + num_steps, search_offset + num_searches)
+        return segment.game_history(step_offset, num_steps, search_offset, num_searches)
 
-        for i, reward in enumerate(
-            game_history.reward_history[index + 1 : bootstrap_index + 1]
-        ):
-            # The value is oriented from the perspective of the current player
-            value += (
-                reward
-                if game_history.to_play_history[index]
-                == game_history.to_play_history[index + i]
-                else -reward
-            ) * self.config.discount ** i
 
-        return value
+class SumTree:
+    """
+    Binary tree where each node holds the sum of the priorities of its two children.
+    Sampling proportionally to the priorities and updating them are done in O(log N).
+    """
 
-    def make_target(self, game_history, state_index):
+    def __init__(self, capacity):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        # The root is nodes[1], the children of nodes[i] are nodes[2i] and nodes[2i+1]
+        # and the leaves are nodes[capacity:]
+        self.nodes = numpy.zeros(2 * self.capacity, dtype="float64")
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, indexes):
+        return self.nodes[numpy.asarray(indexes) + self.capacity]
+
+    def update(self, indexes, priorities):
+        nodes = numpy.unique(numpy.asarray(indexes) + self.capacity)
+        self.nodes[numpy.asarray(indexes) + self.capacity] = priorities
+        # Parents are recomputed from their children to avoid accumulating rounding errors
+        while 0 < len(nodes) and 1 < nodes[0]:
+            nodes = numpy.unique(nodes // 2)
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    def sample(self, batch_size):
         """
-        Generate targets for every unroll steps.
+        Sample batch_size leaves, all of them go down the tree together.
         """
-        target_values, target_rewards, target_policies, actions = [], [], [], []
-        for current_index in range(
-            state_index, state_index + self.config.num_unroll_steps + 1
-        ):
-            value = self.compute_target_value(game_history, current_index)
-
-            if current_index < len(game_history.root_values):
-                target_values.append(value)
-                target_rewards.append(game_history.reward_history[current_index])
-                target_policies.append(game_history.child_visits[current_index])
-                actions.append(game_history.action_history[current_index])
-            elif current_index == len(game_history.root_values):
-                target_values.append(0)
-                target_rewards.append(game_history.reward_history[current_index])
-                # Uniform policy
-                target_policies.append(
-                    [
-                        1 / len(game_history.child_visits[0])
-                        for _ in range(len(game_history.child_visits[0]))
-                    ]
+        values = numpy.random.uniform(0, self.total(), batch_size)
+        nodes = numpy.ones(batch_size, dtype="int64")
+        while nodes[0] < self.capacity:
+            left = self.nodes[2 * nodes]
+            # Never go towards an empty subtree because of rounding errors
+            go_right = (left <= values) & (0 < self.nodes[2 * nodes + 1])
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.capacity
+
+
+class GameStorage:
+    """
+    Games of the replay buffer in memory-mapped files, appended to as the games arrive so
+    that the buffer is always on disk and can be larger than the memory.
+
+    The games are stored in segments of consecutive games, with one file per field of
+    GameHistory where the rows of their positions follow each other. index.bin holds the
+    segment and the offsets of each game, one record per game id. A segment is deleted
+    once all its games left the replay buffer. Reopening a directory only maps its files,
+    the games are GameHistory views into them built when they are accessed.
+
+    A directory must only be used by one GameStorage at a time. To continue the games
+    of another replay buffer, its directory is copied with initial_path. The copy links
+    the files of the segments, which then take no new games.
+    """
+
+    # Columns of the records of index.bin
+    SEGMENT, STEP_OFFSET, NUM_STEPS, SEARCH_OFFSET, NUM_SEARCHES = range(5)
+    # The replay buffer spans this number of segments
+    segments_per_buffer = 16
+    # Fields written after the game is stored, the others never change
+    updated_fields = ("reanalysed_predicted_root_values", "target_values", "priorities")
+
+    def __init__(self, path, config, initial_path=None):
+        self.path = path
+        self.config = config
+        self.games_per_segment = max(
+            1, self.config.replay_buffer_size // self.segments_per_buffer
+        )
+        self.step_fields, self.search_fields = self.fields(self.config)
+
+        os.makedirs(self.path, exist_ok=True)
+        if initial_path:
+            self.copy_games(initial_path)
+        index_path = os.path.join(self.path, "index.bin")
+        with open(index_path, "ab") as index_file:
+            # A record interrupted by the end of the process is dropped
+            record_size = 5 * numpy.dtype("int64").itemsize
+            self.num_games = index_file.tell() // record_size
+            index_file.truncate(self.num_games * record_size)
+        self.index = numpy.fromfile(index_path, dtype="int64").reshape(-1, 5)
+
+        self.segments = {}
+        for name in sorted(os.listdir(self.path)):
+            if name.startswith("segment_"):
+                segment_id = int(name[len("segment_") :])
+                records = self.index[self.index[:, self.SEGMENT] == segment_id]
+                self.segments[segment_id] = GameSegment(
+                    os.path.join(self.path, name),
+                    self.step_fields,
+                    self.search_fields,
+                    records,
                 )
-                actions.append(game_history.action_history[current_index])
-            else:
-                # States past the end of games are treated as absorbing states
-                target_values.append(0)
-                target_rewards.append(0)
-                # Uniform policy
-                target_policies.append(
-                    [
-                        1 / len(game_history.child_visits[0])
-                        for _ in range(len(game_history.child_visits[0]))
-                    ]
+        # Games before the replay buffer window, skipped game ids and games of deleted
+        # segments are not accessible
+        stored = numpy.flatnonzero(
+            numpy.isin(self.index[:, self.SEGMENT], list(self.segments))
+        )
+        self.first_game_id = max(
+            self.num_games - self.config.replay_buffer_size,
+            stored[0] if len(stored) else self.num_games,
+        )
+        self.remove_segments()
+
+    @staticmethod
+    def fields(config):
+        """
+        Fields with a row per position of the game (len(action_history) rows) and with
+        a row per searched position (len(root_values) rows): dtype, row shape. The dtype
+        of the observations is the one of the first game of each segment.
+        """
+        step_fields = {
+            "observation_history": (None, tuple(config.observation_shape)),
+            "action_history": ("int32", ()),
+            "reward_history": ("float32", ()),
+            "to_play_history": ("int8", ()),
+        }
+        search_fields = {
+            "child_visits": ("float32", (len(config.action_space),)),
+            "root_values": ("float32", ()),
+            # NaN until the game is reanalysed
+            "reanalysed_predicted_root_values": ("float32", ()),
+            "target_values": ("float64", ()),
+            "priorities": ("float32", ()),
+        }
+        return step_fields, search_fields
+
+    def copy_games(self, initial_path):
+        """
+        Copy the replay buffer in initial_path, which is left unchanged. The files of
+        the fields which never change are hard links, only the updated fields are copied.
+        """
+        # The index is copied first, the data of its games is already in the segments
+        index_path = os.path.join(self.path, "index.bin")
+        shutil.copyfile(os.path.join(initial_path, "index.bin"), index_path)
+        for name in sorted(os.listdir(initial_path)):
+            if name.startswith("segment_"):
+                os.makedirs(os.path.join(self.path, name))
+                for file_name in os.listdir(os.path.join(initial_path, name)):
+                    source = os.path.join(initial_path, name, file_name)
+                    destination = os.path.join(self.path, name, file_name)
+                    if file_name[: -len(".bin")] in self.updated_fields:
+                        shutil.copyfile(source, destination)
+                        continue
+                    try:
+                        os.link(source, destination)
+                    except OSError:
+                        # File systems without hard links
+                        shutil.copyfile(source, destination)
+
+    def __len__(self):
+        return self.num_games - self.first_game_id
+
+    def __iter__(self):
+        return iter(range(self.first_game_id, self.num_games))
+
+    def __contains__(self, game_id):
+        return self.first_game_id <= game_id < self.num_games
+
+    def __getitem__(self, game_id):
+        """
+        GameHistory with views into the files of the segment of the game.
+        """
+        if game_id not in self:
+            raise KeyError(game_id)
+        segment, *offsets = self.index[game_id].tolist()
+        return self.segments[segment].game_history(*offsets)
+
+    def __delitem__(self, game_id):
+        """
+        Remove the oldest game of the buffer, its segment is deleted with its last game.
+        """
+        if game_id != self.first_game_id:
+            raise KeyError(f"Only the oldest game {self.first_game_id} can be removed.")
+        self.first_game_id += 1
+        self.remove_segments()
+
+    def append(self, game_history):
+        """
+        Write a finished game, with its value targets and priorities, at the end of the
+        storage.
+
+        Returns:
+            The id of the game.
+        """
+        segment_id = -1
+        if self.num_games:
+            segment_id = self.index[self.num_games - 1, self.SEGMENT]
+        segment = self.segments.get(segment_id)
+        observations = game_history.observation_history
+        if (
+            segment is None
+            or segment.shared
+            or self.games_per_segment <= segment.num_games
+            or not numpy.can_cast(
+                observations.dtype, segment.arrays["observation_history"].dtype
+            )
+        ):
+            segment_id = max(self.segments, default=segment_id) + 1
+            step_fields = dict(self.step_fields)
+            step_fields["observation_history"] = (
+                observations.dtype.name,
+                self.config.observation_shape,
+            )
+            segment = GameSegment(
+                os.path.join(self.path, f"segment_{segment_id:06d}"),
+                step_fields,
+                self.search_fields,
+            )
+            self.segments[segment_id] = segment
+
+        record = [segment_id, *segment.append(game_history)]
+        # The game is on disk before its record points to it
+        segment.flush()
+        self.write_records([record])
+        return self.num_games - 1
+
+    def skip(self, num_games):
+        """
+        Skip game ids without storing games, for buffers whose first games are gone.
+        """
+        if 0 < num_games:
+            self.write_records([[-1, 0, 0, 0, 0]] * num_games)
+            self.first_game_id = self.num_games
+
+    def write_records(self, records):
+        records = numpy.array(records, dtype="int64")
+        # The records are written after the data of the games, a game is stored once
+        # its record is complete
+        with open(os.path.join(self.path, "index.bin"), "ab") as index_file:
+            index_file.write(records.tobytes())
+        # The index in memory has spare rows past num_games to append in O(1)
+        if len(self.index) < self.num_games + len(records):
+            index = numpy.zeros(
+                (max(self.num_games + len(records), 2 * len(self.index)), 5),
+                dtype="int64",
+            )
+            index[: self.num_games] = self.index[: self.num_games]
+            self.index = index
+        self.index[self.num_games : self.num_games + len(records)] = records
+        self.num_games += len(records)
+
+    def update_values(self, game_id, game_history):
+        """
+        Write the reanalysed root values and the value targets of a game.
+        """
+        segment, _, _, search_offset, num_searches = self.index[game_id].tolist()
+        arrays = self.segments[segment].arrays
+        searches = slice(search_offset, search_offset + num_searches)
+        if game_history.reanalysed_predicted_root_values is not None:
+            arrays["reanalysed_predicted_root_values"][
+                searches
+            ] = game_history.reanalysed_predicted_root_values
+        arrays["target_values"][searches] = game_history.target_values
+
+    def num_searches(self, game_ids=None):
+        """
+        Number of searched positions of the games, of the games of the buffer by default.
+        """
+        if game_ids is None:
+            game_ids = slice(self.first_game_id, self.num_games)
+        return self.index[: self.num_games][game_ids, self.NUM_SEARCHES]
+
+    def game_priorities(self):
+        """
+        Priorities of the games of the buffer, the maximum of their position priorities.
+        """
+        records = self.index[self.first_game_id : self.num_games]
+        game_priorities = numpy.zeros(len(records))
+        for segment_id in numpy.unique(records[:, self.SEGMENT]):
+            in_segment = records[:, self.SEGMENT] == segment_id
+            priorities = self.segments[segment_id].arrays["priorities"]
+            starts = records[in_segment, self.SEARCH_OFFSET]
+            ends = starts + records[in_segment, self.NUM_SEARCHES]
+            game_priorities[in_segment] = [
+                priorities[start:end].max(initial=0) for start, end in zip(starts, ends)
+            ]
+        return game_priorities
+
+    def remove_segments(self):
+        # Segments whose games are all before the first game of the buffer
+        live_segments = set(
+            self.index[self.first_game_id : self.num_games, self.SEGMENT].tolist()
+        )
+        last_segment = max(self.segments, default=None)
+        for segment_id in list(self.segments):
+            if segment_id not in live_segments and segment_id != last_segment:
+                self.segments.pop(segment_id).delete()
+
+
+class GameSegment:
+    """
+    Consecutive games of a GameStorage, with one memory-mapped file per field. The files
+    grow by doubling their number of rows, the rows past the used ones are not written.
+    """
+
+    def __init__(self, path, step_fields, search_fields, records=None):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        step_fields = dict(step_fields)
+        # The dtype of the observations is chosen with the first game of the segment
+        metadata_path = os.path.join(self.path, "segment.json")
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as metadata_file:
+                observation_dtype = json.load(metadata_file)["observation_dtype"]
+            step_fields["observation_history"] = (
+                observation_dtype,
+                step_fields["observation_history"][1],
+            )
+        else:
+            with open(metadata_path, "w") as metadata_file:
+                json.dump(
+                    {"observation_dtype": step_fields["observation_history"][0]},
+                    metadata_file,
                 )
-                actions.append(numpy.random.choice(self.config.action_space))
+        self.step_fields = step_fields
+        self.search_fields = search_fields
+
+        # Rows used by the games already stored, from their records in the index
+        if records is None:
+            records = numpy.zeros((0, 5), dtype="int64")
+        self.num_games = len(records)
+        step_ends = (
+            records[:, GameStorage.STEP_OFFSET] + records[:, GameStorage.NUM_STEPS]
+        )
+        search_ends = (
+            records[:, GameStorage.SEARCH_OFFSET] + records[:, GameStorage.NUM_SEARCHES]
+        )
+        self.num_steps = int(step_ends.max(initial=0))
+        self.num_searches = int(search_ends.max(initial=0))
 
-        return target_values, target_rewards, target_policies, actions
+        self.memmaps = {}
+        self.arrays = {}
+        for name, (dtype, shape) in {**self.step_fields, **self.search_fields}.items():
+            self.map(name, dtype, shape, 1)
+        # Files linked in the directory of another replay buffer are not appended to
+        self.shared = 1 < os.stat(os.path.join(self.path, "action_history.bin")).st_nlink
+
+    def map(self, name, dtype, shape, num_rows):
+        """
+        Map the file of a field with at least num_rows rows.
+        """
+        dtype = numpy.dtype(dtype)
+        shape = tuple(shape)
+        row_size = dtype.itemsize * int(numpy.prod(shape))
+        file_path = os.path.join(self.path, f"{name}.bin")
+        with open(file_path, "ab") as field_file:
+            field_file.truncate(max(field_file.tell(), num_rows * row_size))
+        num_rows = os.path.getsize(file_path) // row_size
+        self.memmaps[name] = numpy.memmap(
+            file_path, dtype=dtype, mode="r+", shape=(num_rows,) + shape
+        )
+        # A plain ndarray view keeps the mapping alive and is pickled as an array
+        self.arrays[name] = self.memmaps[name].view(numpy.ndarray)
+
+    def map_rows(self, num_steps, num_searches):
+        """
+        Map the files again if their mappings have less rows, when they were written
+        by another process.
+        """
+        for fields, num_rows in (
+            (self.step_fields, num_steps),
+            (self.search_fields, num_searches),
+        ):
+            for name, (dtype, shape) in fields.items():
+                if len(self.arrays[name]) < num_rows:
+                    self.map(name, dtype, shape, num_rows)
+
+    def game_history(self, step_offset, num_steps, search_offset, num_searches):
+        """
+        GameHistory with views into the files of the segment.
+        """
+        game_history = GameHistory()
+        for name in self.step_fields:
+            setattr(
+                game_history,
+                name,
+                self.arrays[name][step_offset : step_offset + num_steps],
+            )
+        for name in self.search_fields:
+            setattr(
+                game_history,
+                name,
+                self.arrays[name][search_offset : search_offset + num_searches],
+            )
+        if numpy.isnan(game_history.reanalysed_predicted_root_values[:1]).any():
+            game_history.reanalysed_predicted_root_values = None
+        return game_history
+
+    def append(self, game_history):
+        """
+        Write the fields of a game after the previous games.
+
+        Returns:
+            The step offset, the number of steps, the search offset and the number of
+            searches of the game.
+        """
+        num_steps = len(game_history.action_history)
+        num_searches = len(game_history.root_values)
+        for fields, offset, length in (
+            (self.step_fields, self.num_steps, num_steps),
+            (self.search_fields, self.num_searches, num_searches),
+        ):
+            for name, (dtype, shape) in fields.items():
+                value = getattr(game_history, name)
+                if value is None:
+                    # Not reanalysed yet
+                    value = numpy.nan
+                num_rows = len(self.arrays[name])
+                if num_rows < offset + length:
+                    self.map(name, dtype, shape, max(offset + length, 2 * num_rows))
+                self.arrays[name][offset : offset + length] = value
+
+        record = [self.num_steps, num_steps, self.num_searches, num_searches]
+        self.num_steps += num_steps
+        self.num_searches += num_searches
+        self.num_games += 1
+        return record
+
+    def flush(self):
+        for memmap in self.memmaps.values():
+            memmap.flush()
+
+    def delete(self):
+        # The views of the games still in use keep their mapping
+        self.memmaps = {}
+        self.arrays = {}
+        shutil.rmtree(self.path, ignore_errors=True)
 
 
 @ray.remote
@@ -285,31 +944,43 @@ class Reanalyse:
     See paper appendix Reanalyse.
     """
 
-    def __init__(self, initial_checkpoint, config):
+    def __init__(self, initial_checkpoint, config, inference_server=None):
         self.config = config
 
         # Fix random generator seed
         numpy.random.seed(self.config.seed)
         torch.manual_seed(self.config.seed)
 
-        # Initialize the network
-        self.model = models.MuZeroNetwork(self.config)
-        self.model.set_weights(initial_checkpoint["weights"])
-        self.model.to(torch.device("cuda" if self.config.reanalyse_on_gpu else "cpu"))
-        self.model.eval()
+        # Initialize the network, or use the one of the inference server
+        self.inference_server = inference_server
+        if self.inference_server:
+            self.model = InferenceClient(self.inference_server)
+        else:
+            self.model = models.inference_network(
+                self.config,
+                torch.device("cuda" if self.config.reanalyse_on_gpu else "cpu"),
+            )
+            self.model.set_weights(initial_checkpoint["weights"])
+            self.weights_version = initial_checkpoint["weights_version"]
 
         self.num_reanalysed_games = initial_checkpoint["num_reanalysed_games"]
 
     def reanalyse(self, replay_buffer, shared_storage):
-        while ray.get(shared_storage.get_info.remote("num_played_games")) < 1:
-            time.sleep(0.1)
+        ray.get(shared_storage.wait_for.remote("num_played_games", 1))
 
-        while ray.get(
-            shared_storage.get_info.remote("training_step")
-        ) < self.config.training_steps and not ray.get(
-            shared_storage.get_info.remote("terminate")
+        info = ray.get(shared_storage.get_info.remote(["training_step", "terminate"]))
+        while (
+            info["training_step"] < self.config.training_steps
+            and not info["terminate"]
         ):
-            self.model.set_weights(ray.get(shared_storage.get_info.remote("weights")))
+            if not self.inference_server:
+                # Fetch the weights only when the trainer published new ones
+                version, weights = ray.get(
+                    shared_storage.get_weights.remote(self.weights_version)
+                )
+                if weights:
+                    self.model.set_weights(ray.get(weights[0]))
+                    self.weights_version = version
 
             game_id, game_history, _ = ray.get(
                 replay_buffer.sample_game.remote(force_uniform=True)
@@ -317,28 +988,25 @@ class Reanalyse:
 
             # Use the last model to provide a fresher, stable n-step value (See paper appendix Reanalyze)
             if self.config.use_last_model_value:
-                observations = [
+                observations = torch.from_numpy(
                     game_history.get_stacked_observations(
-                        i, self.config.stacked_observations
+                        numpy.arange(len(game_history.root_values)),
+                        self.config.stacked_observations,
                     )
-                    for i in range(len(game_history.root_values))
-                ]
-
-                observations = (
-                    torch.tensor(observations)
-                    .float()
-                    .to(next(self.model.parameters()).device)
-                )
-                values = models.support_to_scalar(
-                    self.model.initial_inference(observations)[0],
+                ).to(models.get_device(self.model))
+                (
+                    game_history.reanalysed_predicted_root_values,
+                ) = models.support_to_scalars(
+                    (self.model.initial_inference(observations)[0],),
                     self.config.support_size,
                 )
-                game_history.reanalysed_predicted_root_values = (
-                    torch.squeeze(values).detach().cpu().numpy()
-                )
 
             replay_buffer.update_game_history.remote(game_id, game_history)
             self.num_reanalysed_games += 1
             shared_storage.set_info.remote(
                 "num_reanalysed_games", self.num_reanalysed_games
             )
+
+            info = ray.get(
+                shared_storage.get_info.remote(["training_step", "terminate"])
+            )
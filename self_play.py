@@ -6,6 +6,7 @@ import ray
 import torch
 
 import models
+from inference_server import InferenceClient
 
 
 @ray.remote
@@ -14,7 +15,7 @@ class SelfPlay:
     Class which run in a dedicated thread to play games and save them to the replay-buffer.
     """
 
-    def __init__(self, initial_checkpoint, Game, config, seed):
+    def __init__(self, initial_checkpoint, Game, config, seed, inference_server=None):
         self.config = config
         self.game = Game(seed)
 
@@ -22,26 +23,37 @@ class SelfPlay:
         numpy.random.seed(seed)
         torch.manual_seed(seed)
 
-        # Initialize the network
-        self.model = models.MuZeroNetwork(self.config)
-        self.model.set_weights(initial_checkpoint["weights"])
-        self.model.to(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
-        self.model.eval()
+        # Initialize the network, or use the one of the inference server
+        self.inference_server = inference_server
+        if self.inference_server:
+            self.model = InferenceClient(self.inference_server)
+        else:
+            self.model = models.inference_network(
+                self.config,
+                torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+            )
+            self.model.set_weights(initial_checkpoint["weights"])
+            self.weights_version = initial_checkpoint["weights_version"]
 
     def continuous_self_play(self, shared_storage, replay_buffer, test_mode=False):
-        while ray.get(
-            shared_storage.get_info.remote("training_step")
-        ) < self.config.training_steps and not ray.get(
-            shared_storage.get_info.remote("terminate")
+        info = ray.get(shared_storage.get_info.remote(["training_step", "terminate"]))
+        while (
+            info["training_step"] < self.config.training_steps
+            and not info["terminate"]
         ):
-            self.model.set_weights(ray.get(shared_storage.get_info.remote("weights")))
+            if not self.inference_server:
+                # Fetch the weights only when the trainer published new ones
+                version, weights = ray.get(
+                    shared_storage.get_weights.remote(self.weights_version)
+                )
+                if weights:
+                    self.model.set_weights(ray.get(weights[0]))
+                    self.weights_version = version
 
             if not test_mode:
                 game_history = self.play_game(
                     self.config.visit_softmax_temperature_fn(
-                        trained_steps=ray.get(
-                            shared_storage.get_info.remote("training_step")
-                        )
+                        trained_steps=info["training_step"]
                     ),
                     self.config.temperature_threshold,
                     False,
@@ -49,6 +61,7 @@ class SelfPlay:
                     0,
                 )
 
+                game_history.finalize()
                 replay_buffer.save_game.remote(game_history, shared_storage)
 
             else:
@@ -93,17 +106,11 @@ class SelfPlay:
             if not test_mode and self.config.self_play_delay:
                 time.sleep(self.config.self_play_delay)
             if not test_mode and self.config.ratio:
-                while (
-                    ray.get(shared_storage.get_info.remote("training_step"))
-                    / max(
-                        1, ray.get(shared_storage.get_info.remote("num_played_steps"))
-                    )
-                    < self.config.ratio
-                    and ray.get(shared_storage.get_info.remote("training_step"))
-                    < self.config.training_steps
-                    and not ray.get(shared_storage.get_info.remote("terminate"))
-                ):
-                    time.sleep(0.5)
+                self.wait_for_trainer(shared_storage, self.config)
+
+            info = ray.get(
+                shared_storage.get_info.remote(["training_step", "terminate"])
+            )
 
         self.close_game()
 
@@ -145,7 +152,7 @@ class SelfPlay:
                     root, mcts_info = MCTS(self.config).run(
                         self.model,
                         stacked_observations,
-                        self.game.legal_actions(),
+                        self.root_legal_actions(self.game),
                         self.game.to_play(),
                         True,
                     )
@@ -220,6 +227,38 @@ class SelfPlay:
                 'Wrong argument: "opponent" argument should be "self", "human", "expert" or "random"'
             )
 
+    @staticmethod
+    def root_legal_actions(game):
+        """
+        Legal actions to expand the root with, the mask of the game when it maintains one.
+        """
+        legal_actions_mask = game.legal_actions_mask()
+        if legal_actions_mask is None:
+            return game.legal_actions()
+        return legal_actions_mask
+
+    @staticmethod
+    def wait_for_trainer(shared_storage, config):
+        """
+        Wait until the training steps per self played step ratio is reached. The shared
+        storage notifies every training step, and the number of played steps can grow
+        during the wait.
+        """
+        while True:
+            info = ray.get(
+                shared_storage.get_info.remote(
+                    ["training_step", "num_played_steps", "terminate"]
+                )
+            )
+            minimum_training_step = min(
+                config.ratio * max(1, info["num_played_steps"]), config.training_steps
+            )
+            if minimum_training_step <= info["training_step"] or info["terminate"]:
+                return
+            ray.get(
+                shared_storage.wait_for.remote("training_step", minimum_training_step)
+            )
+
     @staticmethod
     def select_action(node, temperature):
         """
@@ -227,10 +266,9 @@ class SelfPlay:
         The temperature is changed dynamically with the visit_softmax_temperature function
         in the config.
         """
-        visit_counts = numpy.array(
-            [child.visit_count for child in node.children.values()], dtype="int32"
-        )
-        actions = [action for action in node.children.keys()]
+        children = node.children_slice()
+        visit_counts = node.tree.visit_count[children]
+        actions = node.tree.action[children]
         if temperature == 0:
             action = actions[numpy.argmax(visit_counts)]
         elif temperature == float("inf"):
@@ -246,6 +284,155 @@ class SelfPlay:
         return action
 
 
+@ray.remote
+class VectorSelfPlay:
+    """
+    Class which run in a dedicated thread to play several games in lockstep and save
+    them to the replay-buffer. The searches of all the games are run together so that
+    the network evaluates a batch of positions instead of a single one.
+    """
+
+    def __init__(self, initial_checkpoint, Game, config, seed, inference_server=None):
+        self.config = config
+        # The seeds of the games follow the ones of the workers (config.seed + worker
+        # index) and of the test worker (config.seed + num_workers), without overlap
+        worker_index = seed - self.config.seed
+        self.games = [
+            Game(
+                self.config.seed
+                + self.config.num_workers
+                + 1
+                + worker_index * self.config.games_per_worker
+                + i
+            )
+            for i in range(self.config.games_per_worker)
+        ]
+
+        # Fix random generator seed
+        numpy.random.seed(seed)
+        torch.manual_seed(seed)
+
+        # Initialize the network, or use the one of the inference server
+        self.inference_server = inference_server
+        if self.inference_server:
+            self.model = InferenceClient(self.inference_server)
+        else:
+            self.model = models.inference_network(
+                self.config,
+                torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+            )
+            self.model.set_weights(initial_checkpoint["weights"])
+            self.weights_version = initial_checkpoint["weights_version"]
+
+    def continuous_self_play(self, shared_storage, replay_buffer):
+        info = ray.get(shared_storage.get_info.remote(["training_step", "terminate"]))
+        while (
+            info["training_step"] < self.config.training_steps
+            and not info["terminate"]
+        ):
+            if not self.inference_server:
+                # Fetch the weights only when the trainer published new ones
+                version, weights = ray.get(
+                    shared_storage.get_weights.remote(self.weights_version)
+                )
+                if weights:
+                    self.model.set_weights(ray.get(weights[0]))
+                    self.weights_version = version
+
+            game_histories = self.play_games(
+                self.config.visit_softmax_temperature_fn(
+                    trained_steps=info["training_step"]
+                ),
+                self.config.temperature_threshold,
+            )
+
+            for game_history in game_histories:
+                game_history.finalize()
+                replay_buffer.save_game.remote(game_history, shared_storage)
+
+            # Managing the self-play / training ratio
+            if self.config.self_play_delay:
+                time.sleep(self.config.self_play_delay)
+            if self.config.ratio:
+                SelfPlay.wait_for_trainer(shared_storage, self.config)
+
+            info = ray.get(
+                shared_storage.get_info.remote(["training_step", "terminate"])
+            )
+
+        self.close_games()
+
+    def play_games(self, temperature, temperature_threshold):
+        """
+        Play one game on every environment. At each move, the Monte Carlo tree searches
+        of the unfinished games are run together.
+        """
+        game_histories = []
+        for game in self.games:
+            game_history = GameHistory()
+            observation = game.reset()
+            game_history.action_history.append(0)
+            game_history.observation_history.append(observation)
+            game_history.reward_history.append(0)
+            game_history.to_play_history.append(game.to_play())
+            game_histories.append(game_history)
+
+        done = [False] * len(self.games)
+
+        with torch.no_grad():
+            while True:
+                playing = [
+                    i
+                    for i, game_history in enumerate(game_histories)
+                    if not done[i]
+                    and len(game_history.action_history) <= self.config.max_moves
+                ]
+                if not playing:
+                    break
+
+                # Choose the actions
+                results = MCTS(self.config).run_batch(
+                    self.model,
+                    [
+                        game_histories[i].get_stacked_observations(
+                            -1, self.config.stacked_observations
+                        )
+                        for i in playing
+                    ],
+                    [SelfPlay.root_legal_actions(self.games[i]) for i in playing],
+                    [self.games[i].to_play() for i in playing],
+                    True,
+                )
+
+                for i, (root, _) in zip(playing, results):
+                    game_history = game_histories[i]
+                    action = SelfPlay.select_action(
+                        root,
+                        temperature
+                        if not temperature_threshold
+                        or len(game_history.action_history) < temperature_threshold
+                        else 0,
+                    )
+
+                    observation, reward, done[i] = self.games[i].step(action)
+
+                    game_history.store_search_statistics(
+                        root, self.config.action_space
+                    )
+
+                    # Next batch
+                    game_history.action_history.append(action)
+                    game_history.observation_history.append(observation)
+                    game_history.reward_history.append(reward)
+                    game_history.to_play_history.append(self.games[i].to_play())
+
+        return game_histories
+
+    def close_games(self):
+        for game in self.games:
+            game.close()
+
+
 # Game independent
 class MCTS:
     """
@@ -257,6 +444,8 @@ class MCTS:
 
     def __init__(self, config):
         self.config = config
+        # Actions of the nodes expanded inside the search tree
+        self.action_indexes = numpy.array(self.config.action_space)
 
     def run(
         self,
@@ -277,35 +466,8 @@ class MCTS:
             root = override_root_with
             root_predicted_value = None
         else:
-            root = Node(0)
-            observation = (
-                torch.tensor(observation)
-                .float()
-                .unsqueeze(0)
-                .to(next(model.parameters()).device)
-            )
-            (
-                root_predicted_value,
-                reward,
-                policy_logits,
-                hidden_state,
-            ) = model.initial_inference(observation)
-            root_predicted_value = models.support_to_scalar(
-                root_predicted_value, self.config.support_size
-            ).item()
-            reward = models.support_to_scalar(reward, self.config.support_size).item()
-            assert (
-                legal_actions
-            ), f"Legal actions should not be an empty array. Got {legal_actions}."
-            assert set(legal_actions).issubset(
-                set(self.config.action_space)
-            ), "Legal actions should be a subset of the action space."
-            root.expand(
-                legal_actions,
-                to_play,
-                reward,
-                policy_logits,
-                hidden_state,
+            (root,), (root_predicted_value,) = self.initialize_roots(
+                model, [observation], [legal_actions], [to_play]
             )
 
         if add_exploration_noise:
@@ -314,167 +476,488 @@ class MCTS:
                 exploration_fraction=self.config.root_exploration_fraction,
             )
 
-        min_max_stats = MinMaxStats()
+        (max_tree_depth,) = self.search(model, [root], [to_play])
 
-        max_tree_depth = 0
-        for _ in range(self.config.num_simulations):
-            virtual_to_play = to_play
-            node = root
-            search_path = [node]
-            current_tree_depth = 0
+        extra_info = {
+            "max_tree_depth": max_tree_depth,
+            "root_predicted_value": root_predicted_value,
+        }
+        return root, extra_info
+
+    def run_batch(
+        self, model, observations, legal_actions, to_play, add_exploration_noise
+    ):
+        """
+        Run one search per observation, like run. The searches advance together so
+        that every call to the network evaluates the positions of all of them.
 
-            while node.expanded():
-                current_tree_depth += 1
-                action, node = self.select_child(node, min_max_stats)
-                search_path.append(node)
+        Returns:
+            A list of (root, extra_info) pairs, one for each observation.
+        """
+        roots, root_predicted_values = self.initialize_roots(
+            model, observations, legal_actions, to_play
+        )
 
-                # Players play turn by turn
-                if virtual_to_play + 1 < len(self.config.players):
-                    virtual_to_play = self.config.players[virtual_to_play + 1]
-                else:
-                    virtual_to_play = self.config.players[0]
+        if add_exploration_noise:
+            for root in roots:
+                root.add_exploration_noise(
+                    dirichlet_alpha=self.config.root_dirichlet_alpha,
+                    exploration_fraction=self.config.root_exploration_fraction,
+                )
+
+        max_tree_depths = self.search(model, roots, to_play)
+
+        return [
+            (
+                root,
+                {
+                    "max_tree_depth": max_tree_depth,
+                    "root_predicted_value": root_predicted_value,
+                },
+            )
+            for root, max_tree_depth, root_predicted_value in zip(
+                roots, max_tree_depths, root_predicted_values
+            )
+        ]
+
+    def initialize_roots(self, model, observations, legal_actions, to_play):
+        """
+        Create and expand the root of a new search tree for every observation with a
+        single call to the representation function.
+        """
+        observations = (
+            torch.tensor(numpy.array(observations))
+            .float()
+            .to(models.get_device(model))
+        )
+        (
+            root_predicted_values,
+            rewards,
+            policy_logits,
+            hidden_states,
+        ) = model.initial_inference(observations)
+        root_predicted_values, rewards = models.support_to_scalars(
+            (root_predicted_values, rewards), self.config.support_size
+        )
+        policy_logits = policy_logits.detach().cpu().numpy()
+
+        roots = []
+        for i, actions in enumerate(legal_actions):
+            if isinstance(actions, numpy.ndarray) and actions.dtype == bool:
+                # Mask of the legal actions over the action space
+                actions = numpy.flatnonzero(actions)
+            assert (
+                len(actions) > 0
+            ), f"Legal actions should not be an empty array. Got {actions}."
+            assert set(actions).issubset(
+                set(self.config.action_space)
+            ), "Legal actions should be a subset of the action space."
+            # Every simulation expands one node, reserve the space for all of them
+            root = Node(
+                0,
+                SearchTree(
+                    1 + (self.config.num_simulations + 1) * len(self.config.action_space)
+                ),
+            )
+            root.expand(
+                actions,
+                to_play[i],
+                rewards[i].item(),
+                policy_logits[i : i + 1],
+                hidden_states[i : i + 1],
+            )
+            roots.append(root)
+
+        return roots, root_predicted_values.tolist()
+
+    def search(self, model, roots, to_play):
+        """
+        Run the simulations from the expanded roots. At each round, up to mcts_batch_size
+        leaves are selected in every tree and all of them are evaluated by a single call
+        to the dynamics function.
+
+        Returns:
+            The maximum depth reached in each tree.
+        """
+        # The search works on node indexes of the trees, Node objects are only views
+        trees = [root.tree for root in roots]
+        min_max_stats = [MinMaxStats() for _ in roots]
+        max_tree_depths = [0] * len(roots)
+
+        # The trees can run a different number of simulations at each round
+        num_simulations_done = [0] * len(roots)
+        while min(num_simulations_done) < self.config.num_simulations:
+            # Select up to mcts_batch_size distinct leaves in every tree, a virtual loss
+            # keeps the following descents of the round away from the paths already
+            # selected. The round of a tree ends early when a descent reaches a leaf
+            # already selected, so that every simulation evaluates a new leaf.
+            search_paths, actions, leaves_to_play, saved_value_sums = [], [], [], []
+            for t, (tree, root) in enumerate(zip(trees, roots)):
+                search_paths.append([])
+                actions.append([])
+                leaves_to_play.append([])
+                saved_value_sums.append([])
+                batch_size = min(
+                    self.config.mcts_batch_size,
+                    self.config.num_simulations - num_simulations_done[t],
+                )
+                while len(search_paths[t]) < batch_size:
+                    virtual_to_play = to_play[t]
+                    node = root.index
+                    search_path = [node]
+                    current_tree_depth = 0
+
+                    while tree.expanded(node):
+                        current_tree_depth += 1
+                        action, node = self.select_child(tree, node, min_max_stats[t])
+                        search_path.append(node)
+
+                        # Players play turn by turn
+                        if virtual_to_play + 1 < len(self.config.players):
+                            virtual_to_play = self.config.players[virtual_to_play + 1]
+                        else:
+                            virtual_to_play = self.config.players[0]
+
+                    if any(path[-1] == node for path in search_paths[t]):
+                        break
+                    saved_value_sums[t].append(
+                        self.add_virtual_loss(tree, search_path, min_max_stats[t])
+                    )
+                    search_paths[t].append(search_path)
+                    actions[t].append(action)
+                    leaves_to_play[t].append(virtual_to_play)
+                    max_tree_depths[t] = max(max_tree_depths[t], current_tree_depth)
 
             # Inside the search tree we use the dynamics function to obtain the next hidden
             # state given an action and the previous hidden state
-            parent = search_path[-2]
+            leaves = [
+                (t, i) for t in range(len(trees)) for i in range(len(search_paths[t]))
+            ]
+            parent_hidden_states = torch.cat(
+                [trees[t].hidden_states[search_paths[t][i][-2]] for t, i in leaves]
+            )
             value, reward, policy_logits, hidden_state = model.recurrent_inference(
-                parent.hidden_state,
-                torch.tensor([[action]]).to(parent.hidden_state.device),
+                parent_hidden_states,
+                torch.tensor([[actions[t][i]] for t, i in leaves]).to(
+                    parent_hidden_states.device
+                ),
             )
-            value = models.support_to_scalar(value, self.config.support_size).item()
-            reward = models.support_to_scalar(reward, self.config.support_size).item()
-            node.expand(
-                self.config.action_space,
-                virtual_to_play,
-                reward,
-                policy_logits,
-                hidden_state,
+            value, reward = models.support_to_scalars(
+                (value, reward), self.config.support_size
             )
+            policy_logits = policy_logits.detach().cpu().numpy()
+            for j, (t, i) in enumerate(leaves):
+                trees[t].expand(
+                    search_paths[t][i][-1],
+                    self.action_indexes,
+                    leaves_to_play[t][i],
+                    reward[j].item(),
+                    policy_logits[j : j + 1],
+                    hidden_state[j : j + 1],
+                )
 
-            self.backpropagate(search_path, value, virtual_to_play, min_max_stats)
-
-            max_tree_depth = max(max_tree_depth, current_tree_depth)
+            for j, (t, i) in enumerate(leaves):
+                if i == 0:
+                    # The virtual losses are removed in the reverse order of the
+                    # selections to restore the exact value sums
+                    for search_path, saved_value_sum in reversed(
+                        list(zip(search_paths[t], saved_value_sums[t]))
+                    ):
+                        self.remove_virtual_loss(
+                            trees[t], search_path, saved_value_sum
+                        )
+                self.backpropagate(
+                    trees[t],
+                    search_paths[t][i],
+                    value[j].item(),
+                    leaves_to_play[t][i],
+                    min_max_stats[t],
+                )
+                num_simulations_done[t] += 1
 
-        extra_info = {
-            "max_tree_depth": max_tree_depth,
-            "root_predicted_value": root_predicted_value,
-        }
-        return root, extra_info
+        return max_tree_depths
 
-    def select_child(self, node, min_max_stats):
+    def select_child(self, tree, node, min_max_stats):
         """
-        Select the child with the highest UCB score.
+        Select the child with the highest UCB score, ties are broken randomly.
         """
-        max_ucb = max(
-            self.ucb_score(node, child, min_max_stats)
-            for action, child in node.children.items()
+        ucb_scores = self.ucb_scores(tree, node, min_max_stats)
+        child = tree.first_child[node] + numpy.random.choice(
+            numpy.flatnonzero(ucb_scores == ucb_scores.max())
         )
-        action = numpy.random.choice(
-            [
-                action
-                for action, child in node.children.items()
-                if self.ucb_score(node, child, min_max_stats) == max_ucb
-            ]
-        )
-        return action, node.children[action]
+        return tree.action[child], child
 
-    def ucb_score(self, parent, child, min_max_stats):
+    def ucb_scores(self, tree, parent, min_max_stats):
         """
-        The score for a node is based on its value, plus an exploration bonus based on the prior.
+        The score of every child of a node is based on its value, plus an exploration bonus
+        based on its prior. All the children are scored at once.
         """
+        children = tree.children_slice(parent)
+        visit_counts = tree.visit_count[children]
+
         pb_c = (
             math.log(
-                (parent.visit_count + self.config.pb_c_base + 1) / self.config.pb_c_base
+                (tree.visit_count[parent] + self.config.pb_c_base + 1)
+                / self.config.pb_c_base
             )
             + self.config.pb_c_init
         )
-        pb_c *= math.sqrt(parent.visit_count) / (child.visit_count + 1)
+        pb_c = pb_c * (math.sqrt(tree.visit_count[parent]) / (visit_counts + 1))
 
-        prior_score = pb_c * child.prior
+        prior_scores = pb_c * tree.prior[children]
 
-        if child.visit_count > 0:
-            # Mean value Q
-            value_score = min_max_stats.normalize(
-                child.reward
+        # Mean value Q, only for the visited children
+        visited = 0 < visit_counts
+        values = numpy.divide(
+            tree.value_sum[children],
+            visit_counts,
+            out=numpy.zeros(len(visit_counts)),
+            where=visited,
+        )
+        value_scores = numpy.where(
+            visited,
+            min_max_stats.normalize(
+                tree.reward[children]
                 + self.config.discount
-                * (child.value() if len(self.config.players) == 1 else -child.value())
-            )
-        else:
-            value_score = 0
+                * (values if len(self.config.players) == 1 else -values)
+            ),
+            0,
+        )
+
+        return prior_scores + value_scores
+
+    def add_virtual_loss(self, tree, search_path, min_max_stats):
+        """
+        Count a pending lost visit on every node of a selected path so that the next
+        selections of the same round are pushed towards other leaves. The lost visit
+        has the lowest score seen in the tree, from the view of the player selecting the
+        node, it has no value until the tree has min-max statistics.
+
+        Returns:
+            The value sums of the nodes before the loss, to restore them.
+        """
+        nodes = search_path[1:]
+        saved_value_sum = tree.value_sum[nodes].copy()
+        if min_max_stats.maximum > min_max_stats.minimum:
+            # Inverse of the score reward + discount * value of ucb_scores
+            loss = (min_max_stats.minimum - tree.reward[nodes]) / self.config.discount
+            tree.value_sum[nodes] += loss if len(self.config.players) == 1 else -loss
+        tree.visit_count[search_path] += 1
+        return saved_value_sum
 
-        return prior_score + value_score
+    @staticmethod
+    def remove_virtual_loss(tree, search_path, saved_value_sum):
+        tree.value_sum[search_path[1:]] = saved_value_sum
+        tree.visit_count[search_path] -= 1
 
-    def backpropagate(self, search_path, value, to_play, min_max_stats):
+    def backpropagate(self, tree, search_path, value, to_play, min_max_stats):
         """
         At the end of a simulation, we propagate the evaluation all the way up the tree
         to the root.
         """
         if len(self.config.players) == 1:
             for node in reversed(search_path):
-                node.value_sum += value
-                node.visit_count += 1
-                min_max_stats.update(node.reward + self.config.discount * node.value())
+                tree.value_sum[node] += value
+                tree.visit_count[node] += 1
+                min_max_stats.update(
+                    tree.reward[node] + self.config.discount * tree.value(node)
+                )
 
-                value = node.reward + self.config.discount * value
+                value = tree.reward[node] + self.config.discount * value
 
         elif len(self.config.players) == 2:
             for node in reversed(search_path):
-                node.value_sum += value if node.to_play == to_play else -value
-                node.visit_count += 1
-                min_max_stats.update(node.reward + self.config.discount * -node.value())
+                tree.value_sum[node] += (
+                    value if tree.to_play[node] == to_play else -value
+                )
+                tree.visit_count[node] += 1
+                min_max_stats.update(
+                    tree.reward[node] + self.config.discount * -tree.value(node)
+                )
 
                 value = (
-                    -node.reward if node.to_play == to_play else node.reward
+                    -tree.reward[node]
+                    if tree.to_play[node] == to_play
+                    else tree.reward[node]
                 ) + self.config.discount * value
 
         else:
             raise NotImplementedError("More than two player mode not implemented.")
 
 
+class SearchTree:
+    """
+    Store the nodes of a search tree as arrays indexed by node.
+    The children of a node are stored contiguously, starting at first_child.
+    """
+
+    def __init__(self, capacity=1):
+        self.size = 0
+        self.visit_count = numpy.zeros(capacity, dtype="int32")
+        self.value_sum = numpy.zeros(capacity, dtype="float64")
+        self.prior = numpy.zeros(capacity, dtype="float64")
+        self.reward = numpy.zeros(capacity, dtype="float64")
+        self.to_play = numpy.full(capacity, -1, dtype="int32")
+        # Action leading from the parent to the node
+        self.action = numpy.zeros(capacity, dtype="int64")
+        self.first_child = numpy.zeros(capacity, dtype="int32")
+        self.num_children = numpy.zeros(capacity, dtype="int32")
+        # Only expanded nodes have a hidden state
+        self.hidden_states = {}
+
+    def add_nodes(self, number):
+        """
+        Reserve number contiguous new nodes and return the index of the first one.
+        """
+        first = self.size
+        self.size += number
+        if len(self.visit_count) < self.size:
+            capacity = max(self.size, 2 * len(self.visit_count))
+            for name in (
+                "visit_count",
+                "value_sum",
+                "prior",
+                "reward",
+                "to_play",
+                "action",
+                "first_child",
+                "num_children",
+            ):
+                array = getattr(self, name)
+                grown_array = numpy.full(
+                    capacity, -1 if name == "to_play" else 0, dtype=array.dtype
+                )
+                grown_array[: len(array)] = array
+                setattr(self, name, grown_array)
+        return first
+
+    def expanded(self, node):
+        return self.num_children[node] > 0
+
+    def children(self, node):
+        return range(
+            self.first_child[node], self.first_child[node] + self.num_children[node]
+        )
+
+    def children_slice(self, node):
+        return slice(
+            self.first_child[node], self.first_child[node] + self.num_children[node]
+        )
+
+    def value(self, node):
+        if self.visit_count[node] == 0:
+            return 0
+        return self.value_sum[node] / self.visit_count[node]
+
+    def expand(self, node, actions, to_play, reward, policy_logits, hidden_state):
+        """
+        We expand a node using the value, reward and policy prediction obtained from the
+        neural network. actions are the indexes of the actions, or a boolean mask of the
+        legal actions, and policy_logits the logits of the whole action space as a
+        [1, len(action_space)] array or tensor.
+        """
+        self.to_play[node] = to_play
+        self.reward[node] = reward
+        self.hidden_states[node] = hidden_state
+
+        if isinstance(policy_logits, torch.Tensor):
+            policy_logits = policy_logits.detach().cpu().numpy()
+        actions = numpy.asarray(actions)
+        if actions.dtype == bool:
+            # Mask of the legal actions over the action space
+            actions = numpy.flatnonzero(actions)
+        # Softmax over the logits of the actions
+        logits = policy_logits[0][actions].astype("float64")
+        priors = numpy.exp(logits - logits.max())
+        first = self.add_nodes(len(actions))
+        children = slice(first, first + len(actions))
+        self.first_child[node] = first
+        self.num_children[node] = len(actions)
+        self.action[children] = actions
+        self.prior[children] = priors / priors.sum()
+
+
 class Node:
-    def __init__(self, prior):
-        self.visit_count = 0
-        self.to_play = -1
-        self.prior = prior
-        self.value_sum = 0
-        self.children = {}
-        self.hidden_state = None
-        self.reward = 0
+    """
+    View on a node of a SearchTree, Node(prior) creates a new tree with this node as root.
+    """
+
+    def __init__(self, prior, tree=None):
+        self.tree = tree if tree is not None else SearchTree()
+        self.index = self.tree.add_nodes(1)
+        self.tree.prior[self.index] = prior
+
+    @classmethod
+    def from_tree(cls, tree, index):
+        node = cls.__new__(cls)
+        node.tree = tree
+        node.index = index
+        return node
+
+    @property
+    def visit_count(self):
+        return self.tree.visit_count[self.index].item()
+
+    @property
+    def to_play(self):
+        return self.tree.to_play[self.index].item()
+
+    @property
+    def prior(self):
+        return self.tree.prior[self.index].item()
+
+    @prior.setter
+    def prior(self, prior):
+        self.tree.prior[self.index] = prior
+
+    @property
+    def value_sum(self):
+        return self.tree.value_sum[self.index].item()
+
+    @property
+    def reward(self):
+        return self.tree.reward[self.index].item()
+
+    @property
+    def hidden_state(self):
+        return self.tree.hidden_states.get(self.index)
+
+    @property
+    def children(self):
+        return {
+            self.tree.action[child].item(): Node.from_tree(self.tree, child)
+            for child in self.tree.children(self.index)
+        }
+
+    def children_slice(self):
+        return self.tree.children_slice(self.index)
 
     def expanded(self):
-        return len(self.children) > 0
+        return self.tree.expanded(self.index)
 
     def value(self):
-        if self.visit_count == 0:
-            return 0
-        return self.value_sum / self.visit_count
+        return self.tree.value(self.index)
 
     def expand(self, actions, to_play, reward, policy_logits, hidden_state):
         """
         We expand a node using the value, reward and policy prediction obtained from the
         neural network.
         """
-        self.to_play = to_play
-        self.reward = reward
-        self.hidden_state = hidden_state
-
-        policy_values = torch.softmax(
-            torch.tensor([policy_logits[0][a] for a in actions]), dim=0
-        ).tolist()
-        policy = {a: policy_values[i] for i, a in enumerate(actions)}
-        for action, p in policy.items():
-            self.children[action] = Node(p)
+        self.tree.expand(
+            self.index, actions, to_play, reward, policy_logits, hidden_state
+        )
 
     def add_exploration_noise(self, dirichlet_alpha, exploration_fraction):
         """
         At the start of each search, we add dirichlet noise to the prior of the root to
         encourage the search to explore new actions.
         """
-        actions = list(self.children.keys())
-        noise = numpy.random.dirichlet([dirichlet_alpha] * len(actions))
+        children = self.children_slice()
+        noise = numpy.random.dirichlet(
+            [dirichlet_alpha] * self.tree.num_children[self.index]
+        )
         frac = exploration_fraction
-        for a, n in zip(actions, noise):
-            self.children[a].prior = self.children[a].prior * (1 - frac) + n * frac
+        self.tree.prior[children] = self.tree.prior[children] * (1 - frac) + noise * frac
 
 
 class GameHistory:
@@ -490,6 +973,11 @@ class GameHistory:
         self.child_visits = []
         self.root_values = []
         self.reanalysed_predicted_root_values = None
+        # Value targets of every position, computed by the replay buffer
+        self.target_values = None
+        # Ring buffer of the last frames to stack, while the game is played
+        self.stacked_frames = None
+        self.num_stacked_frames = 0
         # For PER
         self.priorities = None
         self.game_priority = None
@@ -497,55 +985,134 @@ class GameHistory:
     def store_search_statistics(self, root, action_space):
         # Turn visit count from root into a policy
         if root is not None:
-            sum_visits = sum(child.visit_count for child in root.children.values())
-            self.child_visits.append(
-                [
-                    root.children[a].visit_count / sum_visits
-                    if a in root.children
-                    else 0
-                    for a in action_space
-                ]
+            children = root.children_slice()
+            sum_visits = root.tree.visit_count[children].sum()
+            visits = dict(
+                zip(
+                    root.tree.action[children].tolist(),
+                    (root.tree.visit_count[children] / sum_visits).tolist(),
+                )
             )
+            self.child_visits.append([visits.get(a, 0) for a in action_space])
 
             self.root_values.append(root.value())
         else:
             self.root_values.append(None)
 
+    def finalize(self):
+        """
+        Convert the histories of a finished game to contiguous arrays.
+        """
+        observations = numpy.array(self.observation_history)
+        self.observation_history = observations.astype(
+            self.observation_dtype(observations)
+        )
+        self.action_history = numpy.array(self.action_history, dtype="int32")
+        self.reward_history = numpy.array(self.reward_history, dtype="float32")
+        self.to_play_history = numpy.array(self.to_play_history, dtype="int8")
+        # child_visits: positions, len(action_space)
+        self.child_visits = numpy.array(self.child_visits, dtype="float32")
+        self.root_values = numpy.array(self.root_values, dtype="float32")
+        self.stacked_frames = None
+
+    @staticmethod
+    def observation_dtype(observations):
+        # Boards and planes of integers fit in a byte, other observations are kept as float32
+        if numpy.array_equal(observations, numpy.round(observations)):
+            if -128 <= observations.min() and observations.max() <= 127:
+                return numpy.int8
+            if 0 <= observations.min() and observations.max() <= 255:
+                return numpy.uint8
+        return numpy.float32
+
     def get_stacked_observations(self, index, num_stacked_observations):
         """
         Generate a new observation with the observation at the index position
         and num_stacked_observations past observations and actions stacked.
+        index can also be an array of positions, the observations are then returned
+        along a first batch dimension, gathered at once from the histories.
         """
         # Convert to positive index
-        index = index % len(self.observation_history)
+        index = numpy.asarray(index) % len(self.observation_history)
 
-        stacked_observations = self.observation_history[index].copy()
-        for past_observation_index in reversed(
-            range(index - num_stacked_observations, index)
-        ):
-            if 0 <= past_observation_index:
-                previous_observation = numpy.concatenate(
-                    (
-                        self.observation_history[past_observation_index],
-                        [
-                            numpy.ones_like(stacked_observations[0])
-                            * self.action_history[past_observation_index + 1]
-                        ],
-                    )
-                )
-            else:
-                previous_observation = numpy.concatenate(
-                    (
-                        numpy.zeros_like(self.observation_history[index]),
-                        [numpy.zeros_like(stacked_observations[0])],
-                    )
-                )
+        if num_stacked_observations == 0 and index.ndim == 0:
+            return numpy.array(self.observation_history[index], dtype="float32")
 
-            stacked_observations = numpy.concatenate(
-                (stacked_observations, previous_observation)
-            )
+        if isinstance(self.observation_history, list):
+            if index.ndim == 0 and index == len(self.observation_history) - 1:
+                return self.get_last_stacked_observations(num_stacked_observations)
+            observation_history = numpy.array(self.observation_history)
+            action_history = numpy.array(self.action_history)
+        else:
+            observation_history = self.observation_history
+            action_history = self.action_history
+
+        # Past positions of each index, the positions before the start of the game
+        # give zero observations and actions
+        positions = index[..., None] - numpy.arange(num_stacked_observations + 1)
+        valid = 0 <= positions
+        positions = numpy.maximum(positions, 0)
+        # Action played after each past position
+        action_positions = numpy.minimum(positions[..., 1:] + 1, index[..., None])
+        # Actions do not fit in the compact type of the observations
+        frames = observation_history[positions].astype("float32")
+        frames *= valid[..., None, None, None]
+        channels, height, width = frames.shape[-3:]
+        past_frames = numpy.empty(
+            index.shape + (num_stacked_observations, channels + 1, height, width),
+            dtype="float32",
+        )
+        past_frames[..., :channels, :, :] = frames[..., 1:, :, :, :]
+        past_frames[..., channels, :, :] = (
+            action_history[action_positions] * valid[..., 1:]
+        )[..., None, None]
+
+        return numpy.concatenate(
+            (
+                frames[..., 0, :, :, :],
+                past_frames.reshape(
+                    index.shape
+                    + (num_stacked_observations * (channels + 1), height, width)
+                ),
+            ),
+            axis=-3,
+        )
 
-        return stacked_observations
+    def get_last_stacked_observations(self, num_stacked_observations):
+        """
+        Stacked observations of the last position of a game in progress. The frames of
+        the last positions, each observation with the action played after it, are kept
+        in a ring buffer updated with the new positions.
+        """
+        num_frames = num_stacked_observations + 1
+        observation = self.observation_history[-1]
+        if self.stacked_frames is None:
+            self.stacked_frames = numpy.zeros(
+                (num_frames, len(observation) + 1) + numpy.shape(observation)[1:],
+                dtype="float32",
+            )
+        channels = self.stacked_frames.shape[1] - 1
+        for position in range(self.num_stacked_frames, len(self.observation_history)):
+            frame = self.stacked_frames[position % num_frames]
+            frame[:channels] = self.observation_history[position]
+            frame[channels] = 0
+            if 0 < position:
+                self.stacked_frames[(position - 1) % num_frames, channels] = (
+                    self.action_history[position]
+                )
+        self.num_stacked_frames = len(self.observation_history)
+
+        index = len(self.observation_history) - 1
+        # Frames of the positions before the start of the game are still zeros
+        past_frames = self.stacked_frames[
+            (index - numpy.arange(1, num_frames)) % num_frames
+        ]
+        return numpy.concatenate(
+            (
+                self.stacked_frames[index % num_frames, :channels],
+                past_frames.reshape((-1,) + self.stacked_frames.shape[2:]),
+            )
+        )
 
 
 class MinMaxStats:
@@ -562,6 +1129,7 @@ class MinMaxStats:
         self.minimum = min(self.minimum, value)
 
     def normalize(self, value):
+        # Works on a single value or on an array of values
         if self.maximum > self.minimum:
             # We normalize only when we have set the maximum and minimum values
             return (value - self.minimum) / (self.maximum - self.minimum)
@@ -1,3 +1,4 @@
+import asyncio
 import copy
 import os
 
@@ -9,21 +10,55 @@ import torch
 class SharedStorage:
     """
     Class which run in a dedicated thread to store the network weights and some information.
+    The workers can wait for an information to change instead of polling it.
     """
 
     def __init__(self, checkpoint, config):
         self.config = config
         self.current_checkpoint = copy.deepcopy(checkpoint)
+        # Number of times each key has been set, to wait for the next update of a key
+        self.versions = {key: 0 for key in self.current_checkpoint}
+        self.updated = asyncio.Condition()
+        # Last weights published by the trainer, as a list holding their reference in the
+        # object store so that Ray does not fetch them when they are passed around.
+        # Without reference, the workers already have the weights of the checkpoint.
+        self.weights = (self.current_checkpoint["weights_version"], None)
+        self.fetched_weights_version = self.current_checkpoint["weights_version"]
 
-    def save_checkpoint(self, path=None):
+    async def save_checkpoint(self, path=None):
         if not path:
             path = os.path.join(self.config.results_path, "model.checkpoint")
 
+        await self.fetch_weights()
         torch.save(self.current_checkpoint, path)
 
-    def get_checkpoint(self):
+    async def get_checkpoint(self):
+        await self.fetch_weights()
         return copy.deepcopy(self.current_checkpoint)
 
+    async def fetch_weights(self):
+        """
+        Put the last published weights in the checkpoint, they are only fetched from the
+        object store when the checkpoint is saved or returned.
+        """
+        version, weights = self.weights
+        if weights and version != self.fetched_weights_version:
+            self.current_checkpoint["weights"] = await weights[0]
+            self.fetched_weights_version = version
+
+    async def set_weights(self, version, weights):
+        self.weights = (version, weights)
+        await self.set_info("weights_version", version)
+
+    def get_weights(self, version):
+        """
+        Return the version and the reference of the published weights, or None instead of
+        the reference when they are not newer than version.
+        """
+        if self.weights[0] == version:
+            return version, None
+        return self.weights
+
     def get_info(self, keys):
         
         if isinstance(keys, str):
@@ -35,10 +70,38 @@ class SharedStorage:
         else:
             raise TypeError
 
-    def set_info(self, keys, values=None):
+    async def set_info(self, keys, values=None):
         if isinstance(keys, str) and values is not None:
-            self.current_checkpoint[keys] = values
-        elif isinstance(keys, dict):
-            self.current_checkpoint.update(keys)
-        else:
+            keys = {keys: values}
+        elif not isinstance(keys, dict):
             raise TypeError
+
+        self.current_checkpoint.update(keys)
+        for key in keys:
+            self.versions[key] = self.versions.get(key, 0) + 1
+        async with self.updated:
+            self.updated.notify_all()
+
+    async def wait_for(self, key, minimum):
+        """
+        Return the value of key once it is at least minimum, or as soon as the training
+        is terminated.
+        """
+        async with self.updated:
+            await self.updated.wait_for(
+                lambda: minimum <= self.current_checkpoint[key]
+                or self.current_checkpoint["terminate"]
+            )
+        return self.current_checkpoint[key]
+
+    async def wait_for_update(self, key, version):
+        """
+        Return the version and the value of key once it is set after the given version,
+        or as soon as the training is terminated.
+        """
+        async with self.updated:
+            await self.updated.wait_for(
+                lambda: version < self.versions.get(key, 0)
+                or self.current_checkpoint["terminate"]
+            )
+        return self.versions.get(key, 0), self.current_checkpoint[key]
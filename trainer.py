@@ -1,5 +1,7 @@
+import collections
 import copy
 import time
+import warnings
 
 import numpy
 import ray
@@ -29,6 +31,9 @@ class Trainer:
         self.model.train()
 
         self.training_step = initial_checkpoint["training_step"]
+        # Version of the published weights, it only increases, also across resumes
+        self.weights_version = initial_checkpoint["weights_version"]
+        self.num_requested_batches = 0
 
         if "cuda" not in str(next(self.model.parameters()).device):
             print("You are not training on GPU.\n")
@@ -52,25 +57,49 @@ class Trainer:
                 f"{self.config.optimizer} is not implemented. You can change the optimizer manually in trainer.py."
             )
 
+        if self.config.training_precision not in ("float32", "bfloat16"):
+            raise NotImplementedError(
+                f"{self.config.training_precision} training is not implemented. Use float32 or bfloat16."
+            )
+        # Unrolled K steps rollout and loss, compiled into a single graph if requested
+        if self.config.compile_training_step:
+            self.unrolled_loss = torch.compile(self.compute_loss)
+        else:
+            self.unrolled_loss = self.compute_loss
+
         if initial_checkpoint["optimizer_state"] is not None:
             print("Loading optimizer...\n")
             self.optimizer.load_state_dict(
                 copy.deepcopy(initial_checkpoint["optimizer_state"])
             )
 
-    def continuous_update_weights(self, replay_buffer, shared_storage):
+    def continuous_update_weights(
+        self, replay_buffer, shared_storage, batch_builders=None
+    ):
         # Wait for the replay buffer to be filled
-        while ray.get(shared_storage.get_info.remote("num_played_games")) < 1:
-            time.sleep(0.1)
-
-        next_batch = replay_buffer.get_batch.remote()
+        ray.get(shared_storage.wait_for.remote("num_played_games", 1))
+        # Resolved by the shared storage when the training is terminated
+        terminated = shared_storage.wait_for.remote("terminate", True)
+
+        # Keep prefetch_batches batches in flight to always have one ready
+        next_batches = collections.deque(
+            self.request_batch(replay_buffer, batch_builders)
+            for _ in range(self.config.prefetch_batches)
+        )
+        # Time spent in update_weights since the last checkpoint, for the steps/sec
+        training_time = 0
+        training_steps_per_second = 0
         # Training loop
-        while self.training_step < self.config.training_steps and not ray.get(
-            shared_storage.get_info.remote("terminate")
+        while (
+            self.training_step < self.config.training_steps
+            and not ray.wait([terminated], timeout=0)[0]
         ):
-            index_batch, batch = ray.get(next_batch)
-            next_batch = replay_buffer.get_batch.remote()
+            start = time.time()
+            index_batch, batch = ray.get(next_batches.popleft())
+            data_wait_time = time.time() - start
+            next_batches.append(self.request_batch(replay_buffer, batch_builders))
             self.update_lr()
+            start = time.time()
             (
                 priorities,
                 total_loss,
@@ -78,6 +107,7 @@ class Trainer:
                 reward_loss,
                 policy_loss,
             ) = self.update_weights(batch)
+            training_time += time.time() - start
 
             if self.config.PER:
                 # Save new priorities in the replay buffer (See https://arxiv.org/abs/1803.00933)
@@ -85,9 +115,18 @@ class Trainer:
 
             # Save to the shared storage
             if self.training_step % self.config.checkpoint_interval == 0:
+                training_steps_per_second = self.config.checkpoint_interval / max(
+                    training_time, 1e-9
+                )
+                training_time = 0
+                # Weights are copied once in the object store and fetched by the workers
+                # only when their version changed
+                self.weights_version += 1
+                shared_storage.set_weights.remote(
+                    self.weights_version, [ray.put(self.model.get_weights())]
+                )
                 shared_storage.set_info.remote(
                     {
-                        "weights": copy.deepcopy(self.model.get_weights()),
                         "optimizer_state": copy.deepcopy(
                             models.dict_to_cpu(self.optimizer.state_dict())
                         ),
@@ -103,6 +142,8 @@ class Trainer:
                     "value_loss": value_loss,
                     "reward_loss": reward_loss,
                     "policy_loss": policy_loss,
+                    "data_wait_time": data_wait_time,
+                    "training_steps_per_second": training_steps_per_second,
                 }
             )
 
@@ -110,16 +151,46 @@ class Trainer:
             if self.config.training_delay:
                 time.sleep(self.config.training_delay)
             if self.config.ratio:
+                # The shared storage notifies every saved game
+                num_played_steps = ray.get(
+                    shared_storage.get_info.remote("num_played_steps")
+                )
                 while (
-                    self.training_step
-                    / max(
-                        1, ray.get(shared_storage.get_info.remote("num_played_steps"))
-                    )
-                    > self.config.ratio
+                    self.training_step / max(1, num_played_steps) > self.config.ratio
                     and self.training_step < self.config.training_steps
-                    and not ray.get(shared_storage.get_info.remote("terminate"))
+                    and not ray.wait([terminated], timeout=0)[0]
                 ):
-                    time.sleep(0.5)
+                    num_played_steps = ray.get(
+                        shared_storage.wait_for.remote(
+                            "num_played_steps", self.training_step / self.config.ratio
+                        )
+                    )
+
+    def request_batch(self, replay_buffer, batch_builders):
+        """
+        Ask the next batch to the replay buffer, or in turn to each batch builder.
+        """
+        if batch_builders:
+            self.num_requested_batches += 1
+            return batch_builders[
+                self.num_requested_batches % len(batch_builders)
+            ].get_batch.remote(replay_buffer)
+        return replay_buffer.get_batch.remote()
+
+    @staticmethod
+    def to_tensor(array, device):
+        """
+        Tensor sharing the memory of an array of the batch, the arrays of get_batch
+        already have the dtype used by the training.
+        """
+        with warnings.catch_warnings():
+            # Arrays coming from the object store are read only, they are never written
+            warnings.filterwarnings("ignore", "The given NumPy array is not writable")
+            tensor = torch.from_numpy(array)
+        if device.type == "cuda":
+            # Copy once to page-locked memory to send the batch asynchronously
+            tensor = tensor.pin_memory().to(device, non_blocking=True)
+        return tensor
 
     def update_weights(self, batch):
         """
@@ -136,19 +207,15 @@ class Trainer:
             gradient_scale_batch,
         ) = batch
 
-        # Keep values as scalars for calculating the priorities for the prioritized replay
-        target_value_scalar = numpy.array(target_value, dtype="float32")
-        priorities = numpy.zeros_like(target_value_scalar)
-
         device = next(self.model.parameters()).device
         if self.config.PER:
-            weight_batch = torch.tensor(weight_batch.copy()).float().to(device)
-        observation_batch = torch.tensor(observation_batch).float().to(device)
-        action_batch = torch.tensor(action_batch).long().to(device).unsqueeze(-1)
-        target_value = torch.tensor(target_value).float().to(device)
-        target_reward = torch.tensor(target_reward).float().to(device)
-        target_policy = torch.tensor(target_policy).float().to(device)
-        gradient_scale_batch = torch.tensor(gradient_scale_batch).float().to(device)
+            weight_batch = self.to_tensor(weight_batch, device)
+        observation_batch = self.to_tensor(observation_batch, device)
+        action_batch = self.to_tensor(action_batch, device).unsqueeze(-1)
+        target_value = self.to_tensor(target_value, device)
+        target_reward = self.to_tensor(target_reward, device)
+        target_policy = self.to_tensor(target_policy, device)
+        gradient_scale_batch = self.to_tensor(gradient_scale_batch, device)
         # observation_batch: batch, channels, height, width
         # action_batch: batch, num_unroll_steps+1, 1 (unsqueeze)
         # target_value: batch, num_unroll_steps+1
@@ -156,6 +223,8 @@ class Trainer:
         # target_policy: batch, num_unroll_steps+1, len(action_space)
         # gradient_scale_batch: batch, num_unroll_steps+1
 
+        # Keep values as scalars for calculating the priorities for the prioritized replay
+        target_value_scalar = target_value
         target_value = models.scalar_to_support(target_value, self.config.support_size)
         target_reward = models.scalar_to_support(
             target_reward, self.config.support_size
@@ -163,90 +232,31 @@ class Trainer:
         # target_value: batch, num_unroll_steps+1, 2*support_size+1
         # target_reward: batch, num_unroll_steps+1, 2*support_size+1
 
-        ## Generate predictions
-        value, reward, policy_logits, hidden_state = self.model.initial_inference(
-            observation_batch
-        )
-        predictions = [(value, reward, policy_logits)]
-        for i in range(1, action_batch.shape[1]):
-            value, reward, policy_logits, hidden_state = self.model.recurrent_inference(
-                hidden_state, action_batch[:, i]
+        with torch.autocast(
+            device.type,
+            dtype=torch.bfloat16,
+            enabled=self.config.training_precision == "bfloat16",
+        ):
+            value_loss, reward_loss, policy_loss, values = self.unrolled_loss(
+                observation_batch,
+                action_batch,
+                target_value,
+                target_reward,
+                target_policy,
+                gradient_scale_batch,
             )
-            # Scale the gradient at the start of the dynamics function (See paper appendix Training)
-            hidden_state.register_hook(lambda grad: grad * 0.5)
-            predictions.append((value, reward, policy_logits))
-        # predictions: num_unroll_steps+1, 3, batch, 2*support_size+1 | 2*support_size+1 | 9 (according to the 2nd dim)
 
-        ## Compute losses
-        value_loss, reward_loss, policy_loss = (0, 0, 0)
-        value, reward, policy_logits = predictions[0]
-        # Ignore reward loss for the first batch step
-        current_value_loss, _, current_policy_loss = self.loss_function(
-            value.squeeze(-1),
-            reward.squeeze(-1),
-            policy_logits,
-            target_value[:, 0],
-            target_reward[:, 0],
-            target_policy[:, 0],
-        )
-        value_loss += current_value_loss
-        policy_loss += current_policy_loss
-        # Compute priorities for the prioritized replay (See paper appendix Training)
-        pred_value_scalar = (
-            models.support_to_scalar(value, self.config.support_size)
-            .detach()
+        # Compute priorities for the prioritized replay (See paper appendix Training),
+        # for all the unroll steps at once and with a single transfer to the host
+        pred_value_scalar = models.support_to_scalar(
+            values.detach(), self.config.support_size
+        ).squeeze(-1)
+        priorities = (
+            (torch.abs(pred_value_scalar - target_value_scalar) ** self.config.PER_alpha)
             .cpu()
             .numpy()
-            .squeeze()
-        )
-        priorities[:, 0] = (
-            numpy.abs(pred_value_scalar - target_value_scalar[:, 0])
-            ** self.config.PER_alpha
         )
 
-        for i in range(1, len(predictions)):
-            value, reward, policy_logits = predictions[i]
-            (
-                current_value_loss,
-                current_reward_loss,
-                current_policy_loss,
-            ) = self.loss_function(
-                value.squeeze(-1),
-                reward.squeeze(-1),
-                policy_logits,
-                target_value[:, i],
-                target_reward[:, i],
-                target_policy[:, i],
-            )
-
-            # Scale gradient by the number of unroll steps (See paper appendix Training)
-            current_value_loss.register_hook(
-                lambda grad: grad / gradient_scale_batch[:, i]
-            )
-            current_reward_loss.register_hook(
-                lambda grad: grad / gradient_scale_batch[:, i]
-            )
-            current_policy_loss.register_hook(
-                lambda grad: grad / gradient_scale_batch[:, i]
-            )
-
-            value_loss += current_value_loss
-            reward_loss += current_reward_loss
-            policy_loss += current_policy_loss
-
-            # Compute priorities for the prioritized replay (See paper appendix Training)
-            pred_value_scalar = (
-                models.support_to_scalar(value, self.config.support_size)
-                .detach()
-                .cpu()
-                .numpy()
-                .squeeze()
-            )
-            priorities[:, i] = (
-                numpy.abs(pred_value_scalar - target_value_scalar[:, i])
-                ** self.config.PER_alpha
-            )
-
         # Scale the value loss, paper recommends by 0.25 (See paper appendix Reanalyze)
         loss = value_loss * self.config.value_loss_weight + reward_loss + policy_loss
         if self.config.PER:
@@ -270,6 +280,66 @@ class Trainer:
             policy_loss.mean().item(),
         )
 
+    def compute_loss(
+        self,
+        observation_batch,
+        action_batch,
+        target_value,
+        target_reward,
+        target_policy,
+        gradient_scale_batch,
+    ):
+        """
+        Unroll the model over the num_unroll_steps actions of the batch and compute the
+        losses of every sample. The whole rollout and loss can be compiled with
+        torch.compile, the gradients are scaled with scale_gradient instead of hooks.
+
+        Returns:
+            The value, reward and policy losses of every sample and the value logits of
+            every unroll step (batch, num_unroll_steps+1, 2*support_size+1).
+        """
+        ## Generate predictions
+        value, reward, policy_logits, hidden_state = self.model.initial_inference(
+            observation_batch
+        )
+        predictions = [(value, reward, policy_logits)]
+        for i in range(1, action_batch.shape[1]):
+            # recurrent_inference split to scale the gradient of the hidden state for
+            # both the prediction and the next dynamics
+            hidden_state, reward = self.model.dynamics(hidden_state, action_batch[:, i])
+            # Scale the gradient at the start of the dynamics function (See paper appendix Training)
+            hidden_state = self.scale_gradient(hidden_state, 0.5)
+            policy_logits, value = self.model.prediction(hidden_state)
+            predictions.append((value, reward, policy_logits))
+        values, rewards, policy_logits = (
+            torch.stack(prediction, dim=1).float() for prediction in zip(*predictions)
+        )
+        # values: batch, num_unroll_steps+1, 2*support_size+1
+        # rewards: batch, num_unroll_steps+1, 2*support_size+1
+        # policy_logits: batch, num_unroll_steps+1, len(action_space)
+
+        ## Compute losses of all the unroll steps at once
+        value_loss, reward_loss, policy_loss = self.loss_function(
+            values, rewards, policy_logits, target_value, target_reward, target_policy
+        )
+        # Scale gradient by the number of unroll steps (See paper appendix Training),
+        # except for the initial inference
+        gradient_scale = 1 / gradient_scale_batch
+        gradient_scale[:, 0] = 1
+        value_loss = self.scale_gradient(value_loss, gradient_scale).sum(1)
+        # Ignore reward loss for the first batch step
+        reward_loss = self.scale_gradient(reward_loss, gradient_scale)[:, 1:].sum(1)
+        policy_loss = self.scale_gradient(policy_loss, gradient_scale).sum(1)
+
+        return value_loss, reward_loss, policy_loss, values
+
+    @staticmethod
+    def scale_gradient(tensor, scale):
+        """
+        Identity in the forward pass, multiply the gradient by scale in the backward pass.
+        """
+        return tensor * scale + tensor.detach() * (1 - scale)
+
     def update_lr(self):
         """
         Update learning rate
@@ -289,10 +359,11 @@ class Trainer:
         target_reward,
         target_policy,
     ):
-        # Cross-entropy seems to have a better convergence than MSE
-        value_loss = (-target_value * torch.nn.LogSoftmax(dim=1)(value)).sum(1)
-        reward_loss = (-target_reward * torch.nn.LogSoftmax(dim=1)(reward)).sum(1)
-        policy_loss = (-target_policy * torch.nn.LogSoftmax(dim=1)(policy_logits)).sum(
-            1
+        # Cross-entropy seems to have a better convergence than MSE, computed over the
+        # last dimension for single steps or stacked unroll steps alike
+        value_loss = (-target_value * torch.log_softmax(value, dim=-1)).sum(-1)
+        reward_loss = (-target_reward * torch.log_softmax(reward, dim=-1)).sum(-1)
+        policy_loss = (-target_policy * torch.log_softmax(policy_logits, dim=-1)).sum(
+            -1
         )
         return value_loss, reward_loss, policy_loss